@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import tempfile
+import cv2
+import numpy as np
+
+from depth2rgb import depth2rgb
+from utils.benchmarks import COLOR_MODES, DEPTH_MODES, report_environment, time_it
+
+# Period between frames of synthetic recordings, μs (30 fps)
+FRAME_PERIOD = 33333
+
+this_file_path = os.path.dirname(os.path.abspath(__file__))
+
+def synthetic_intrinsics(shape, fov_deg):
+    h, w = shape
+    f = w / 2 / np.tan(np.deg2rad(fov_deg) / 2)
+    return {'parameters' : {'parameters_as_dict' : {'cx' : w / 2 - 0.5, 'cy' : h / 2 - 0.5, 'fx' : f, 'fy' : f,
+                                                    'k1' : 0.5, 'k2' : -2.7, 'k3' : 1.6, 'k4' : 0.4, 'k5' : -2.5, 'k6' : 1.5,
+                                                    'codx' : 0.0, 'cody' : 0.0, 'p1' : 1e-4, 'p2' : -5e-5, 'metric_radius' : 1.7}}}
+
+# Write calib_params.json in the schema of mrob_calibration_params_extractor
+# Params: path, depth_shape, color_shape
+def write_synthetic_calib_params(path, depth_shape, color_shape):
+    rotation, _ = cv2.Rodrigues(np.array([0.1, -0.002, 0.001]))
+    calib_params = {'depth_camera' : {'resolution_height' : depth_shape[0], 'resolution_width' : depth_shape[1],
+                                      'intrinsics' : synthetic_intrinsics(depth_shape, 75)},
+                    'color_camera' : {'resolution_height' : color_shape[0], 'resolution_width' : color_shape[1],
+                                      'intrinsics' : synthetic_intrinsics(color_shape, 90),
+                                      'extrinsics' : {'rotation' : rotation.reshape(-1).tolist(),
+                                                      'translation_in_meters' : [-32.0, -2.0, 4.0]}}}
+    with open(os.path.join(path, 'calib_params.json'), 'w') as f:
+        json.dump(calib_params, f)
+
+# Synthetic depth of a tilted plane with noise and holes in mm, and color gradient with noise
+# Params: depth_shape, color_shape, seed
+def synthetic_frames(depth_shape, color_shape, seed=0):
+    rng = np.random.default_rng(seed)
+    h, w = depth_shape
+    grid_y, grid_x = np.mgrid[0:h, 0:w]
+    img_depth = 1000 + 2000 * grid_x / w + 500 * grid_y / h + rng.normal(0, 10, depth_shape)
+    img_depth[rng.random(depth_shape) < 0.05] = 0
+    h, w = color_shape
+    gradient = (np.arange(w)[None, :, None] * 255 // w + np.arange(h)[:, None, None] * 255 // h) // 2
+    img_rgb = np.broadcast_to(gradient, (h, w, 3)) + rng.integers(0, 16, (h, w, 3))
+    return img_depth.astype(np.uint16), np.clip(img_rgb, 0, 255).astype(np.uint8)
+
+# Create camera folder with calib_params.json and synthetic color and depth frames
+# Params: path, depth_shape, color_shape, frames, images
+def create_synthetic_camera(path, depth_shape, color_shape, frames, images=True):
+    for folder in ('color', 'depth'):
+        os.makedirs(os.path.join(path, folder), exist_ok=True)
+    write_synthetic_calib_params(path, depth_shape, color_shape)
+    img_depth, img_rgb = synthetic_frames(depth_shape, color_shape)
+    rng = np.random.default_rng(0)
+    for i in range(frames):
+        ts = i * FRAME_PERIOD
+        # Depth timestamps jitter around color ones, some of them are too far to correspond
+        depth_ts = ts + int(rng.integers(-300, 300)) if i % 50 != 49 else ts + 5000
+        if images:
+            cv2.imwrite(os.path.join(path, 'color', f'{ts:012}.png'), img_rgb)
+            cv2.imwrite(os.path.join(path, 'depth', f'{depth_ts:012}.png'), img_depth)
+        else:
+            open(os.path.join(path, 'color', f'{ts:012}.png'), 'w').close()
+            open(os.path.join(path, 'depth', f'{depth_ts:012}.png'), 'w').close()
+
+def create_aligner(path, output_folder):
+    calib_params = os.path.join(path, 'calib_params.json')
+    return depth2rgb(path_to_depth_params=calib_params,
+                     path_to_rgb_params=calib_params,
+                     path_to_extrinsics_params=calib_params,
+                     path_to_rgb_camera_images=os.path.join(path, 'color', ''),
+                     path_to_depth_camera_images=os.path.join(path, 'depth', ''),
+                     output_folder=output_folder,
+                     rgb_format='png',
+                     depth_format='png')
+
+def benchmark_matching(workdir, frame_counts, repeats):
+    results = []
+    for frames in frame_counts:
+        path = os.path.join(workdir, f'matching_{frames}')
+        create_synthetic_camera(path, DEPTH_MODES['NFOV_UNBINNED'], COLOR_MODES['720p'], frames, images=False)
+        aligner = create_aligner(path, workdir)
+        def match_quietly():
+            # Summary of omitted timestamps would be printed on every run
+            with contextlib.redirect_stdout(io.StringIO()):
+                aligner.create_timestamps_correspondance_dict()
+        stats = time_it(match_quietly, repeats)
+        results.append({'benchmark' : 'create_timestamps_correspondance_dict', 'frames' : frames, **stats})
+    return results
+
+def benchmark_modes(workdir, depth_mode, color_mode, repeats):
+    depth_shape, color_shape = DEPTH_MODES[depth_mode], COLOR_MODES[color_mode]
+    path = os.path.join(workdir, f'{depth_mode}_{color_mode}')
+    create_synthetic_camera(path, depth_shape, color_shape, frames=1)
+    aligner = create_aligner(path, workdir)
+    img_depth, img_rgb = synthetic_frames(depth_shape, color_shape)
+    img_depth_undistorted = cv2.remap(img_depth, *aligner.map_d, cv2.INTER_LINEAR)
+    pcd_image, img_rgb_undistorted = aligner.align_pair(img_depth, img_rgb)
+    pcd_image = pcd_image.copy()
+    color_path = os.path.join(path, 'color', os.listdir(os.path.join(path, 'color'))[0])
+    depth_path = os.path.join(path, 'depth', os.listdir(os.path.join(path, 'depth'))[0])
+    output_path = os.path.join(workdir, 'output.png')
+
+    benchmarks = {
+        'undistort_image_color' : lambda: aligner.undistort_image(img_rgb, aligner.Kc, aligner.Dc, aligner.Kc_undistorted, cv2.INTER_LINEAR),
+        'undistort_image_depth' : lambda: aligner.undistort_image(img_depth, aligner.Kd, aligner.Dd, aligner.Kd_undistorted, cv2.INTER_LINEAR),
+        'remap_color' : lambda: cv2.remap(img_rgb, *aligner.map_c, cv2.INTER_LINEAR),
+        'remap_depth' : lambda: cv2.remap(img_depth, *aligner.map_d, cv2.INTER_LINEAR),
+        'pointcloudify_depths' : lambda: aligner.pointcloudify_depths(img_depth_undistorted, aligner.Kd_undistorted),
+        'pointcloudify_depths_precomputed' : lambda: aligner.pointcloudify_depths(img_depth_undistorted),
+        'project_depth' : lambda: aligner.project_depth(img_depth_undistorted),
+        'align_pair' : lambda: aligner.align_pair(img_depth, img_rgb),
+        'imread_color' : lambda: cv2.imread(color_path),
+        'imread_depth' : lambda: cv2.imread(depth_path, cv2.IMREAD_UNCHANGED),
+        'imwrite_color' : lambda: cv2.imwrite(output_path, img_rgb_undistorted),
+        'imwrite_depth' : lambda: cv2.imwrite(output_path, pcd_image),
+    }
+    results = []
+    for name, function in benchmarks.items():
+        stats = time_it(function, repeats)
+        results.append({'benchmark' : name, 'depth_mode' : depth_mode, 'color_mode' : color_mode, **stats})
+        print(f'{depth_mode:>15} {color_mode:>6} {name:>33}: {stats["median_s"] * 1000:9.2f} ms')
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of depth2rgb hot paths on synthetic data. No cameras or Azure SDK are needed.')
+    parser.add_argument('--depth_modes',
+                        type=str,
+                        nargs='+',
+                        choices=list(DEPTH_MODES.keys()),
+                        default=['NFOV_UNBINNED', 'WFOV_UNBINNED'],
+                        help='Depth modes to benchmark')
+    parser.add_argument('--color_modes',
+                        type=str,
+                        nargs='+',
+                        choices=list(COLOR_MODES.keys()),
+                        default=['720p', '1536p', '3072p'],
+                        help='Color modes to benchmark')
+    parser.add_argument('--frame_counts',
+                        type=int,
+                        nargs='+',
+                        default=[1000, 10000, 50000],
+                        help='Numbers of frames for timestamps matching benchmark')
+    parser.add_argument('--repeats',
+                        type=int,
+                        default=10,
+                        help='Number of timed runs of every benchmark')
+    parser.add_argument('-o',
+                        '--output',
+                        type=str,
+                        default='benchmark_depth2rgb.json',
+                        help='Path to JSON file with results')
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for depth_mode in args.depth_modes:
+            for color_mode in args.color_modes:
+                results += benchmark_modes(workdir, depth_mode, color_mode, args.repeats)
+        for result in benchmark_matching(workdir, args.frame_counts, args.repeats):
+            print(f'{"matching":>22} {result["frames"]:>6} frames: {result["median_s"] * 1000:9.2f} ms')
+            results.append(result)
+
+    report = {**report_environment(),
+              'numpy' : np.__version__,
+              'opencv' : cv2.__version__,
+              'results' : results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Results are saved to {args.output}')
+
+if __name__ == '__main__':
+    main()
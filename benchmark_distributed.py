@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+
+import argparse
+import collections
+import csv
+import itertools
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import requests
+
+import recorder
+from utils.benchmarks import report_environment
+
+this_file_path = os.path.dirname(os.path.abspath(__file__))
+simulator = os.path.join(this_file_path, 'mrob_recorder_sim.py')
+
+SERVER_START_TIMEOUT = 20 # seconds
+STOP_TIMEOUT = 10 # seconds
+
+# Start server.py instances on consecutive ports, every one with its own simulated cameras, tmpfs images and records folders
+# Params: workdir, nodes, base_port, cameras_per_node
+def start_nodes(workdir, nodes, base_port, cameras_per_node=1):
+    servers = []
+    addresses = []
+    for i in range(nodes):
+        node_path = os.path.join(workdir, f'node_{i}')
+        env = dict(os.environ,
+                   MROB_RECORDER=simulator,
+                   MROB_SIM_SERIALS=','.join(f'{i:06}{j:06}' for j in range(cameras_per_node)),
+                   MROB_SIM_SYNC_FILE=os.path.join(workdir, 'sync'),
+                   MROB_IMAGES_PATH=os.path.join(node_path, 'images'),
+                   MROB_RECORDS_PATH=os.path.join(node_path, 'records'))
+        servers.append(subprocess.Popen([sys.executable, '-m', 'uvicorn', 'server:app', '--port', str(base_port + i), '--log-level', 'warning'],
+                                        cwd=this_file_path, env=env))
+        addresses.append(f'127.0.0.1:{base_port + i}/')
+
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    for address in addresses:
+        while True:
+            try:
+                requests.get(f'http://{address}get_camera_list', timeout=1)
+                break
+            except requests.RequestException:
+                if time.monotonic() > deadline:
+                    stop_nodes(servers)
+                    raise RuntimeError(f'Server {address} is not started in {SERVER_START_TIMEOUT} s')
+                time.sleep(0.1)
+    return servers, addresses
+# Return: servers, addresses
+
+def stop_nodes(servers):
+    for server in servers:
+        server.terminate()
+    for server in servers:
+        server.wait()
+
+# Start time of capturing of every camera, the first row of its timestamps table
+# Params: workdir, cameras, file_base_name
+def first_capture_times(workdir, cameras, file_base_name):
+    times = []
+    for node, _, filename in cameras:
+        with open(os.path.join(workdir, f'node_{node}', 'records', file_base_name, filename.replace('.mkv', '.csv'))) as f:
+            rows = list(csv.DictReader(f))
+        times.append(int(rows[0]['system_time_ns']) if len(rows) > 0 else None)
+    return times
+
+def stats(values):
+    return {'min_s' : min(values), 'median_s' : float(np.median(values)), 'max_s' : max(values)}
+
+# Launch, poll and stop recording on simulated nodes with the same calls as recorder.py in distributed mode.
+# Master is the first camera of the first node, other cameras of its node are subordinates on the same server
+# Params: workdir, nodes, base_port, duration, polls, rate, cameras_per_node
+def benchmark_nodes(workdir, nodes, base_port, duration, polls, rate, cameras_per_node=1):
+    servers, addresses = start_nodes(workdir, nodes, base_port, cameras_per_node)
+    try:
+        file_base_name = 'benchmark'
+        # (node, device, filename) of every camera
+        cameras = [(node, device, f'{node * cameras_per_node + device}{"m" if node == 0 and device == 0 else "s"}.mkv')
+                   for node in range(nodes) for device in range(cameras_per_node)]
+        cmd_lines = [f'--device {device} --external-sync {"Master" if filename.endswith("m.mkv") else "Subordinate"} --rate {rate} '
+                     f'--depth-mode NFOV_UNBINNED --color-mode 720p {filename} {filename.replace(".mkv", ".csv")}' for _, device, filename in cameras]
+        master_address = addresses[0]
+        # Several subordinates on one node are launched one by one, nodes are launched concurrently like in recorder.py
+        subordinate_cmd_lines = collections.defaultdict(list)
+        for (node, _, _), cmd_line in zip(cameras[1:], cmd_lines[1:]):
+            subordinate_cmd_lines[addresses[node]].append(cmd_line)
+        subordinate_addresses = list(subordinate_cmd_lines.keys())
+        def launch_node_recorders(address):
+            for cmd_line in subordinate_cmd_lines[address]:
+                recorder.launch_remote_recorder(address, cmd_line, file_base_name)
+
+        start = time.perf_counter()
+        recorder.fan_out(launch_node_recorders, subordinate_addresses)
+        launch_s = time.perf_counter() - start
+
+        start = time.perf_counter()
+        not_ready = recorder.wait_distributed_subordinates_ready(subordinate_addresses)
+        ready_s = time.perf_counter() - start
+        if len(not_ready) > 0:
+            raise RuntimeError('Subordinates are not ready: ' + ', '.join(not_ready))
+        recorder.launch_remote_recorder(master_address, cmd_lines[0], file_base_name)
+
+        time.sleep(duration)
+        poll_times = []
+        for _ in range(polls):
+            start = time.perf_counter()
+            metrics = recorder.fan_out(recorder.get_distributed_recording_metrics, addresses)
+            poll_times.append(time.perf_counter() - start)
+        not_running = [address for address, m in zip(addresses, metrics) if m is None or not all(r['recording_is_running'] for r in m.values())]
+
+        start = time.perf_counter()
+        recorder.fan_out(recorder.stop_remote_recorder, addresses)
+        stop_request_s = time.perf_counter() - start
+        # Stop is complete when every recorder has exited
+        while time.perf_counter() - start < STOP_TIMEOUT:
+            metrics = recorder.fan_out(recorder.get_distributed_recording_metrics, addresses)
+            if all(m is not None and not any(r['recording_is_running'] for r in m.values()) for m in metrics):
+                break
+            time.sleep(0.01)
+        stop_complete_s = time.perf_counter() - start
+
+        capture_times = [t for t in first_capture_times(workdir, cameras, file_base_name) if t is not None]
+        return {'nodes' : nodes,
+                'cameras_per_node' : cameras_per_node,
+                'launch_subordinates_s' : launch_s,
+                'wait_ready_s' : ready_s,
+                'capture_start_skew_s' : (max(capture_times) - min(capture_times)) / 1e9 if len(capture_times) == len(cameras) else None,
+                'status_poll' : stats(poll_times),
+                'stop_request_s' : stop_request_s,
+                'stop_complete_s' : stop_complete_s,
+                'not_running_during_polls' : not_running}
+    finally:
+        stop_nodes(servers)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of distributed recording control with local server.py instances '
+                                                 'and simulated mrob_recorder. No cameras or Azure SDK are needed.')
+    parser.add_argument('--node_counts',
+                        type=int,
+                        nargs='+',
+                        default=[1, 2, 4, 8],
+                        help='Numbers of simulated nodes')
+    parser.add_argument('--cameras_per_node',
+                        type=int,
+                        nargs='+',
+                        default=[1, 2],
+                        help='Numbers of simulated cameras on every node, several cameras on a node share its tmpfs images')
+    parser.add_argument('--base_port',
+                        type=int,
+                        default=8100,
+                        help='Port of the first server, next servers use next ports')
+    parser.add_argument('--duration',
+                        type=float,
+                        default=2,
+                        help='Seconds of recording before status polls')
+    parser.add_argument('--polls',
+                        type=int,
+                        default=20,
+                        help='Number of timed status polls of all nodes')
+    parser.add_argument('--rate',
+                        type=int,
+                        default=30,
+                        help='Frame rate of simulated cameras')
+    parser.add_argument('-o',
+                        '--output',
+                        type=str,
+                        default='benchmark_distributed.json',
+                        help='Path to JSON file with results')
+    args = parser.parse_args()
+
+    results = []
+    for cameras_per_node, nodes in itertools.product(args.cameras_per_node, args.node_counts):
+        workdir = tempfile.mkdtemp()
+        try:
+            result = benchmark_nodes(workdir, nodes, args.base_port, args.duration, args.polls, args.rate, cameras_per_node)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        skew = f'{result["capture_start_skew_s"] * 1000:7.1f}' if result['capture_start_skew_s'] is not None else '     --'
+        print(f'{nodes:>3} nodes x {cameras_per_node} cameras: launch {result["launch_subordinates_s"] * 1000:7.1f} ms, ready {result["wait_ready_s"] * 1000:7.1f} ms, '
+              f'capture skew {skew} ms, status poll median {result["status_poll"]["median_s"] * 1000:6.1f} ms '
+              f'max {result["status_poll"]["max_s"] * 1000:6.1f} ms, stop {result["stop_request_s"] * 1000:6.1f} ms '
+              f'complete {result["stop_complete_s"] * 1000:7.1f} ms')
+        results.append(result)
+
+    report = {**report_environment(),
+              'results' : results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Results are saved to {args.output}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import tempfile
+import numpy as np
+from PIL import Image
+
+from streamer import DEPTH_RANGE_DEFAULT, DEPTH_DECIMATION, colorize_depth, depth_colormap_lut, read_depth
+from utils.benchmarks import DEPTH_MODES, report_environment, time_it
+
+# Min/max rescale of depth to grayscale, the depth preview of streamer before colormap LUT
+def rescale(array):
+    out = 255.0 / (array.max() - array.min()) * (array - array.min())
+    return out.astype(np.uint8)
+
+def prepare_depth_rescale(path, shape):
+    array = np.fromfile(path, dtype=np.uint16)
+    array = rescale(array)
+    return Image.fromarray(array.reshape(shape)[::DEPTH_DECIMATION, ::DEPTH_DECIMATION])
+
+def prepare_depth_lut(path, lut, buffers):
+    array = read_depth(path, buffers)
+    return colorize_depth(array[::DEPTH_DECIMATION, ::DEPTH_DECIMATION], lut)
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-benchmark of streamer depth preview: min/max rescale vs colormap LUT on synthetic frames.')
+    parser.add_argument('--repeats', type=int, default=200, help='Number of timed runs of every benchmark')
+    parser.add_argument('-o', '--output', type=str, default='benchmark_streamer.json', help='Path to JSON file with results')
+    args = parser.parse_args()
+
+    lut = depth_colormap_lut(DEPTH_RANGE_DEFAULT)
+    rng = np.random.default_rng(0)
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for depth_mode in ['NFOV_UNBINNED', 'WFOV_UNBINNED']:
+            shape = DEPTH_MODES[depth_mode]
+            path = os.path.join(workdir, f'{depth_mode}.bin')
+            rng.integers(0, 5000, shape, dtype=np.uint16).tofile(path)
+            buffers = {}
+            for name, function in [('rescale', lambda: prepare_depth_rescale(path, shape)),
+                                   ('lut', lambda: prepare_depth_lut(path, lut, buffers))]:
+                stats = time_it(function, args.repeats)
+                results.append({'benchmark' : name, 'depth_mode' : depth_mode, **stats})
+                print(f'{depth_mode:>15} {name:>8}: {stats["median_s"] * 1000:7.3f} ms')
+
+    with open(args.output, 'w') as f:
+        json.dump({**report_environment(), 'results' : results}, f, indent=2)
+    print(f'Results are saved to {args.output}')
+
+if __name__ == '__main__':
+    main()
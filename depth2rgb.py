@@ -1,13 +1,30 @@
 #!/usr/bin/env python3
 
 import argparse
+import hashlib
 import json
 import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
 from shutil import rmtree
 from tqdm import tqdm
 import cv2
 import numpy as np
 
+from utils.frame_chunks import FrameChunkWriter
+
+# Number of frames sent to a worker process at once in parallel mode
+FRAMES_PER_TASK = 16
+# Max difference between rgb and depth timestamps to consider them corresponding, μs
+TIMESTAMPS_TOLERANCE = 1000
+# File in the output folder with completed pairs of incremental runs
+MANIFEST_FILENAME = 'manifest.jsonl'
+# Point of binary PLY files: coordinates in color camera frame and color
+PLY_POINT_DTYPE = np.dtype([('x', '<f4'), ('y', '<f4'), ('z', '<f4'), ('red', 'u1'), ('green', 'u1'), ('blue', 'u1')])
+# Point is visible in color camera if it is farther than the nearest point of its pixel by no more than this share of depth
+VISIBILITY_TOLERANCE = 0.01
+
 class depth2rgb:
 
     def __init__(self, path_to_depth_params,
@@ -17,13 +34,62 @@ class depth2rgb:
                 path_to_depth_camera_images,
                 output_folder,
                 rgb_format,
-                depth_format):
+                depth_format,
+                png_compression=None,
+                readers=2,
+                writers=2,
+                read_queue_depth=8,
+                write_queue_depth=8,
+                output_backend='files',
+                point_cloud_params=None,
+                shared_tables=None):
+        """
+        :param shared_tables: dict shared by aligners of several camera pairs, None if the aligner is used alone.
+                              Undistortion maps and depth rays are computed once per camera and projection buffers
+                              once per pair of image shapes, so aligners sharing it must not project concurrently
+        """
+        # Kept to build identical aligners in worker processes
+        self.init_params = {'path_to_depth_params' : path_to_depth_params,
+                            'path_to_rgb_params' : path_to_rgb_params,
+                            'path_to_extrinsics_params' : path_to_extrinsics_params,
+                            'path_to_rgb_camera_images' : path_to_rgb_camera_images,
+                            'path_to_depth_camera_images' : path_to_depth_camera_images,
+                            'output_folder' : output_folder,
+                            'rgb_format' : rgb_format,
+                            'depth_format' : depth_format,
+                            'png_compression' : png_compression,
+                            'readers' : readers,
+                            'writers' : writers,
+                            'read_queue_depth' : read_queue_depth,
+                            'write_queue_depth' : write_queue_depth,
+                            'output_backend' : output_backend,
+                            'point_cloud_params' : point_cloud_params}
+
         self.path_to_rgb_camera_images = path_to_rgb_camera_images
         self.path_to_depth_camera_images = path_to_depth_camera_images
         self.output_folder = output_folder
         self.rgb_format = rgb_format
         self.depth_format = depth_format
 
+        ########### I/O pipeline parameters ###########
+        self.png_compression = png_compression
+        self.readers = readers
+        self.writers = writers
+        self.read_queue_depth = read_queue_depth
+        self.write_queue_depth = write_queue_depth
+
+        ########### Output backend ###########
+        # 'files' saves a pair of images per frame, 'chunks' appends frames to large chunk files
+        if output_backend not in ('files', 'chunks'):
+            raise ValueError(f'Output backend {output_backend} is not supported')
+        self.output_backend = output_backend
+        self.output_container = None
+        self.manifest = None
+
+        ########### Point cloud export ###########
+        # None disables export, otherwise dict with 'voxel_size' and 'depth_range', both can be None
+        self.point_cloud_params = point_cloud_params
+
         ########### load dictionaries with intrinsics and extinsics ###########
         with open(path_to_depth_params) as f:
             temp = json.load(f)['depth_camera']
@@ -85,6 +151,56 @@ class depth2rgb:
         self.Kc_undistorted = self.undistort_calibration_matrix(self.shape_c, self.Kc, self.Dc)
         self.Kd_undistorted = self.undistort_calibration_matrix(self.shape_d, self.Kd, self.Dd)
 
+        def shared(key, compute):
+            if shared_tables is None:
+                return compute()
+            if key not in shared_tables:
+                shared_tables[key] = compute()
+            return shared_tables[key]
+
+        ########### Lookup tables ###########
+        # Calibration doesn't change inside a folder, so remap maps, depth rays
+        # and depth-to-color projection are computed once instead of for every frame.
+        # Maps and rays depend on one camera only and are shared by its pairs
+        self.map_c = shared(('map_c', path_to_rgb_params),
+                            lambda: self.undistortion_maps(self.shape_c, self.Kc, self.Dc, self.Kc_undistorted))
+        self.map_d = shared(('map_d', path_to_depth_params),
+                            lambda: self.undistortion_maps(self.shape_d, self.Kd, self.Dd, self.Kd_undistorted))
+        self.depth_rays = shared(('depth_rays', path_to_depth_params), lambda: self.norm_grid(self.shape_d, self.Kd_undistorted))
+        self.depth2color_projection = self.Kc_undistorted @ self.T[:3, :]
+
+        ########### Per-frame buffers ###########
+        # Projection runs in float32 on buffers reused for every frame
+        P = self.depth2color_projection.astype(np.float32)
+        self.depth2color_rotation = np.ascontiguousarray(P[:, :3].T)
+        self.depth2color_translation = P[:, 3].copy()
+
+        buffers = shared(('buffers', self.shape_d, self.shape_c), lambda: self.projection_buffers(self.shape_d, self.shape_c))
+        for name, buffer in buffers.items():
+            setattr(self, name, buffer)
+
+    @staticmethod
+    def projection_buffers(shape_d, shape_c):
+        """
+        Returns dict of buffers of project_depth by their attribute names.
+        :param shape_d: shape of depth image [h, w]
+        :param shape_c: shape of color image [h, w]
+        """
+        h, w = shape_c
+        n = shape_d[0] * shape_d[1]
+        # The last element of zbuffer collects points projected outside of the image
+        return {'pcd_buffer' : np.empty((n, 3), dtype=np.float32),
+                'proj_buffer' : np.empty((n, 3), dtype=np.float32),
+                'u_buffer' : np.empty(n, dtype=np.float32),
+                'v_buffer' : np.empty(n, dtype=np.float32),
+                'u_index_buffer' : np.empty(n, dtype=np.int32),
+                'pixel_index_buffer' : np.empty(n, dtype=np.int32),
+                'valid_buffer' : np.empty(n, dtype=bool),
+                'mask_buffer' : np.empty(n, dtype=bool),
+                'zbuffer' : np.empty(h * w + 1, dtype=np.float32),
+                'zbuffer_empty' : np.empty(h * w + 1, dtype=bool),
+                'pcd_image' : np.empty((h, w), dtype=np.uint16)}
+
     @staticmethod
     def undistort_calibration_matrix(shape, calibration_matrix, dist_coeff):
         """
@@ -118,6 +234,17 @@ class depth2rgb:
 
         return undist_image
 
+    @staticmethod
+    def undistortion_maps(shape, calibration_matrix, dist_coeff, undist_calibration_matrix):
+        """
+        Returns fixed-point remap maps for undistortion.
+        :param shape: shape of image [h, w]
+        :param calibration_matrix: calibration matrix [3 x 3]
+        :param dist_coeff: distortions vector
+        :param undist_calibration_matrix: undistorted calibration matrix [3 x 3]
+        """
+        return cv2.initUndistortRectifyMap(calibration_matrix, dist_coeff, None, undist_calibration_matrix, shape[::-1], cv2.CV_16SC2)
+
     @staticmethod
     def to_homogeneous(t):
         """
@@ -142,23 +269,33 @@ class depth2rgb:
         """
         return (np.linalg.inv(calibration_matrix) @ self.to_homogeneous(loc_kp).T).T
 
-    def pointcloudify_depths(self, img_depth, undist_calibration_matrix):
+    def norm_grid(self, shape, undist_calibration_matrix):
         """
-        Transform from depth image frame to depth camera frame.
-        :param img_depth: np.ndarray, depth image
+        Returns normalized image coordinates (rays) of every pixel, np.ndarray(h * w, 3).
+        :param shape: shape of image [h, w]
         :param undist_calibration_matrix: undistorted calibration matrix [3 x 3]
         """
-        shape = img_depth.shape[::-1]
-
-        grid_x, grid_y = np.meshgrid(np.arange(shape[0]), np.arange(shape[1]))
+        grid_x, grid_y = np.meshgrid(np.arange(shape[1]), np.arange(shape[0]))
         grid = np.concatenate([np.expand_dims(grid_x, -1),
                                np.expand_dims(grid_y, -1)], axis=-1)
 
-        norm_grid = self.to_norm_image_coord(grid.reshape(-1, 2), undist_calibration_matrix)
+        return self.to_norm_image_coord(grid.reshape(-1, 2), undist_calibration_matrix).astype(np.float32)
+
+    def pointcloudify_depths(self, img_depth, undist_calibration_matrix=None):
+        """
+        Transform from depth image frame to depth camera frame.
+        :param img_depth: np.ndarray, depth image
+        :param undist_calibration_matrix: undistorted calibration matrix [3 x 3].
+                                          If None, precomputed depth camera rays are used
+        """
+        if undist_calibration_matrix is None:
+            norm_grid = self.depth_rays
+        else:
+            norm_grid = self.norm_grid(img_depth.shape, undist_calibration_matrix)
 
         # Raise by undistorted depth value from image plane to local camera space
-        local_grid = norm_grid * np.expand_dims(img_depth.reshape(-1), axis=-1)
-        return local_grid.astype(np.float32)
+        local_grid = norm_grid * np.expand_dims(img_depth.reshape(-1), axis=-1).astype(np.float32)
+        return local_grid
 
 
     def project2image(self, scene_points, undistorted_calibration_matrix):
@@ -169,6 +306,133 @@ class depth2rgb:
         return self.to_cartesian((undistorted_calibration_matrix @ scene_points.T).T)
 
 
+    def project_depth(self, img_depth_undistorted):
+        """
+        Project undistorted depth image onto undistorted color image plane.
+        Points landing to the same pixel are resolved by z-buffering: the nearest one is kept.
+        Returns depth image in color camera frame, np.ndarray([h, w]) of uint16.
+        The array is an internal buffer overwritten by the next call.
+        :param img_depth_undistorted: undistorted depth image, np.ndarray([N1, N2])
+        """
+        h, w = self.shape_c
+        depth = img_depth_undistorted.reshape(-1)
+        valid, mask = self.valid_buffer, self.mask_buffer
+        u, v = self.u_buffer, self.v_buffer
+        u_index, pixel_index = self.u_index_buffer, self.pixel_index_buffer
+
+        # Depth camera frame -> color camera frame -> color image plane
+        np.multiply(self.depth_rays, depth[:, None], out=self.pcd_buffer)
+        np.matmul(self.pcd_buffer, self.depth2color_rotation, out=self.proj_buffer)
+        self.proj_buffer += self.depth2color_translation
+        z = self.proj_buffer[:, 2]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            np.divide(self.proj_buffer[:, 0], z, out=u)
+            np.divide(self.proj_buffer[:, 1], z, out=v)
+        np.rint(u, out=u)
+        np.rint(v, out=v)
+
+        # Keep measured points in front of the camera that land inside the image
+        np.greater(depth, 0, out=valid)
+        for condition, array, bound in ((np.greater, z, 0),
+                                        (np.greater_equal, u, 0), (np.less, u, w),
+                                        (np.greater_equal, v, 0), (np.less, v, h)):
+            condition(array, bound, out=mask)
+            valid &= mask
+        np.logical_not(valid, out=mask)
+
+        # Flat pixel index, invalid points go to the extra zbuffer element
+        np.copyto(u, 0, where=mask)
+        np.copyto(v, 0, where=mask)
+        np.copyto(u_index, u, casting='unsafe')
+        np.copyto(pixel_index, v, casting='unsafe')
+        pixel_index *= w
+        pixel_index += u_index
+        np.copyto(pixel_index, h * w, where=mask)
+
+        self.zbuffer.fill(np.inf)
+        np.minimum.at(self.zbuffer, pixel_index, z)
+        np.isinf(self.zbuffer, out=self.zbuffer_empty)
+        np.copyto(self.zbuffer, 0, where=self.zbuffer_empty)
+
+        np.copyto(self.pcd_image, self.zbuffer[:-1].reshape(h, w), casting='unsafe')
+        return self.pcd_image
+
+    def point_cloud_of_last_projection(self, img_rgb_undistorted, depth_range=None, voxel_size=None):
+        """
+        Returns colored point cloud of the last project_depth call as points in color camera frame np.ndarray(N, 3)
+        of float32 and their RGB colors np.ndarray(N, 3) of uint8.
+        Only points visible in color camera are kept, occluded ones would get colors of the surface in front of them.
+        :param img_rgb_undistorted: undistorted rgb image, np.ndarray([N1, N2, 3])
+        :param depth_range: (min, max) depth in color camera frame to keep points within, None to keep all
+        :param voxel_size: size of voxel grid to average points in, None to keep all
+        """
+        # Nearest depth of every pixel is left in zbuffer by project_depth
+        valid = self.valid_buffer.copy()
+        nearest = self.zbuffer[self.pixel_index_buffer[valid]]
+        valid[valid] = self.proj_buffer[valid, 2] <= nearest * (1 + VISIBILITY_TOLERANCE)
+        P = self.T[:3, :].astype(np.float32)
+        points = self.pcd_buffer[valid] @ P[:, :3].T + P[:, 3]
+        colors = img_rgb_undistorted[self.v_buffer[valid].astype(np.int32), self.u_buffer[valid].astype(np.int32), ::-1]
+
+        if depth_range is not None:
+            in_range = (points[:, 2] >= depth_range[0]) & (points[:, 2] <= depth_range[1])
+            points, colors = points[in_range], colors[in_range]
+
+        if voxel_size is not None and len(points) > 0:
+            points, colors = self.voxel_downsample(points, colors, voxel_size)
+        return points, colors
+
+    @staticmethod
+    def voxel_downsample(points, colors, voxel_size):
+        """
+        Returns points and colors averaged in every occupied voxel of the grid.
+        :param points: np.ndarray(N, 3) of float32
+        :param colors: np.ndarray(N, 3) of uint8
+        :param voxel_size: size of voxel in units of points
+        """
+        voxels = np.floor(points / voxel_size).astype(np.int64)
+        voxels -= voxels.min(axis=0)
+        # One integer key per voxel instead of slow np.unique over rows
+        dims = voxels.max(axis=0) + 1
+        keys = (voxels[:, 0] * dims[1] + voxels[:, 1]) * dims[2] + voxels[:, 2]
+        _, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+
+        downsampled_points = np.empty((len(counts), 3), dtype=np.float32)
+        downsampled_colors = np.empty((len(counts), 3), dtype=np.uint8)
+        for i in range(3):
+            downsampled_points[:, i] = np.bincount(inverse, weights=points[:, i]) / counts
+            downsampled_colors[:, i] = np.rint(np.bincount(inverse, weights=colors[:, i]) / counts)
+        return downsampled_points, downsampled_colors
+
+    @staticmethod
+    def write_ply(path, points, colors):
+        """
+        Save colored point cloud to binary PLY file.
+        :param points: np.ndarray(N, 3) of float32
+        :param colors: np.ndarray(N, 3) of uint8, RGB
+        """
+        vertices = np.empty(len(points), dtype=PLY_POINT_DTYPE)
+        vertices['x'], vertices['y'], vertices['z'] = points.T
+        vertices['red'], vertices['green'], vertices['blue'] = colors.T
+        header = ('ply\n'
+                  'format binary_little_endian 1.0\n'
+                  f'element vertex {len(points)}\n'
+                  'property float x\nproperty float y\nproperty float z\n'
+                  'property uchar red\nproperty uchar green\nproperty uchar blue\n'
+                  'end_header\n')
+        with open(path, 'wb') as f:
+            f.write(header.encode('ascii'))
+            vertices.tofile(f)
+
+    def point_cloud_for_pair(self, img_rgb_undistorted):
+        """
+        Returns point cloud of the last aligned pair if point cloud export is on, otherwise None.
+        """
+        if self.point_cloud_params is None:
+            return None
+        return self.point_cloud_of_last_projection(img_rgb_undistorted, **self.point_cloud_params)
+
     def depth2rgb_for_pair(self, img_depth, img_rgb, timestamp_rgb):
         """
         depth2rgb procedure for one pair of input depth and rgb images.
@@ -177,51 +441,478 @@ class depth2rgb:
         :param img_rgb: rgb image, np.ndarray([N1, N2, 3])
         :param timestamp_rgb: relative time of capturing rgb image. Used for naming output files.
         """
-        img_rgb_undistorted = self.undistort_image(img_rgb, self.Kc, self.Dc, self.Kc_undistorted, cv2.INTER_LINEAR)
-        img_depth_undistorted = self.undistort_image(img_depth, self.Kd, self.Dd, self.Kd_undistorted, cv2.INTER_LINEAR)
+        pcd_image, img_rgb_undistorted = self.align_pair(img_depth, img_rgb)
+        point_cloud = self.point_cloud_for_pair(img_rgb_undistorted)
+        frame = self.save_pair(pcd_image, img_rgb_undistorted, timestamp_rgb, point_cloud)
+        if frame is not None:
+            self.output_container.append(frame)
 
-        local_depth_camera_pcd = self.pointcloudify_depths(img_depth_undistorted, self.Kd_undistorted)
-        local_rgb_camera_pcd = self.to_cartesian((self.T @ self.to_homogeneous(local_depth_camera_pcd).transpose()).transpose())
+    def align_pair(self, img_depth, img_rgb):
+        """
+        Returns depth image projected onto color image and undistorted color image.
+        Projected depth image is an internal buffer overwritten by the next call.
+        :param img_depth: depth image, np.ndarray([N1, N2])
+        :param img_rgb: rgb image, np.ndarray([N1, N2, 3])
+        """
+        img_rgb_undistorted = cv2.remap(img_rgb, *self.map_c, cv2.INTER_LINEAR)
+        img_depth_undistorted = cv2.remap(img_depth, *self.map_d, cv2.INTER_LINEAR)
 
-        h, w = self.shape_c
-        depth = local_rgb_camera_pcd[:, 2]
+        return self.project_depth(img_depth_undistorted), img_rgb_undistorted
+
+    def imwrite_params(self, image_format):
+        if image_format == 'png' and self.png_compression is not None:
+            return [cv2.IMWRITE_PNG_COMPRESSION, self.png_compression]
+        return []
 
-        proj_pcd = self.project2image(local_rgb_camera_pcd, self.Kc_undistorted)
-        proj_pcd = np.round(proj_pcd).astype(int)[:, [0, 1]]
+    def save_pair(self, pcd_image, img_rgb_undistorted, timestamp_rgb, point_cloud=None):
+        """
+        Save depth image projected onto color image and undistorted color image.
+        With chunks output backend, returns the encoded frame to be appended to output container instead.
+        :param pcd_image: depth image projected onto color image, np.ndarray([N1, N2])
+        :param img_rgb_undistorted: undistorted rgb image, np.ndarray([N1, N2, 3])
+        :param timestamp_rgb: relative time of capturing rgb image. Used for naming output files.
+        :param point_cloud: (points, colors) to save to 'point_cloud' folder, None to skip
+        """
+        if point_cloud is not None:
+            self.write_ply(self.output_folder + '/point_cloud/' + timestamp_rgb + '.ply', *point_cloud)
 
-        proj_mask = (proj_pcd[:, 0] >= 0) & (proj_pcd[:, 0] < w) & (proj_pcd[:, 1] >= 0) & (proj_pcd[:, 1] < h)
-        proj_pcd = proj_pcd[proj_mask, :]
-        depth = depth[proj_mask]
+        if self.output_container is not None:
+            return self.output_container.encode(timestamp_rgb, pcd_image, img_rgb_undistorted)
 
-        pcd_image = np.zeros((h, w))
-        pcd_image[proj_pcd[:, 1], proj_pcd[:, 0]] = depth
+        cv2.imwrite(self.output_folder + '/depth/' + timestamp_rgb + '.' + self.depth_format, pcd_image,
+                    self.imwrite_params(self.depth_format))
+        cv2.imwrite(self.output_folder + '/color/' + timestamp_rgb + '.' + self.rgb_format, img_rgb_undistorted,
+                    self.imwrite_params(self.rgb_format))
 
-        cv2.imwrite(self.output_folder + '/depth/' + timestamp_rgb + '.' + self.depth_format, pcd_image.astype(np.uint16))
-        cv2.imwrite(self.output_folder + '/color/' + timestamp_rgb + '.' + self.rgb_format, img_rgb_undistorted)
+    @staticmethod
+    def scan_timestamps(path):
+        """
+        Returns sorted timestamps of images in the folder and the images format.
+        The folder is listed only once.
+        :param path: path to the folder with images named by timestamps, format: '.../color/'
+        """
+        timestamps = []
+        image_format = None
+        with os.scandir(path) as entries:
+            for entry in entries:
+                name, image_format = entry.name.split('.')
+                timestamps.append(int(name))
+        return np.sort(np.array(timestamps, dtype=np.int64)), image_format
 
     def create_timestamps_correspondance_dict(self):
         self.rgb_to_depth_timestamps_correspondance_dict = {}
-        rgb_timestamps = np.array([int(path.split('.')[0]) for path in os.listdir(self.path_to_rgb_camera_images)])
-        depth_timestamps = np.array([int(path.split('.')[0]) for path in os.listdir(self.path_to_depth_camera_images)])
+        rgb_timestamps, rgb_input_format = self.scan_timestamps(self.path_to_rgb_camera_images)
+        depth_timestamps, depth_input_format = self.scan_timestamps(self.path_to_depth_camera_images)
+
+        if len(rgb_timestamps) == 0 or len(depth_timestamps) == 0:
+            print(f'No images to find correspondences, {len(rgb_timestamps)} rgb and {len(depth_timestamps)} depth images')
+            return
 
-        rgb_input_format = os.listdir(self.path_to_rgb_camera_images)[0].split('.')[1]
-        depth_input_format = os.listdir(self.path_to_depth_camera_images)[0].split('.')[1]
+        # Nearest depth timestamp is either right before or right after the rgb one
+        right = np.clip(np.searchsorted(depth_timestamps, rgb_timestamps), 1, len(depth_timestamps) - 1)
+        left = right - 1
+        if len(depth_timestamps) == 1:
+            left = right = np.zeros_like(right)
+        left_diff = np.abs(rgb_timestamps - depth_timestamps[left])
+        right_diff = np.abs(rgb_timestamps - depth_timestamps[right])
+        cor_idx = np.where(right_diff < left_diff, right, left)
+        diff = np.minimum(left_diff, right_diff)
 
-        for ts in rgb_timestamps:
-            cor_idx = np.argmin(np.abs(ts - depth_timestamps))
-            if np.abs(ts - depth_timestamps[cor_idx]) < 1000:
-                self.rgb_to_depth_timestamps_correspondance_dict[f'{ts:012}.{rgb_input_format}'] = f'{depth_timestamps[cor_idx]:012}.{depth_input_format}'
+        matched = diff < TIMESTAMPS_TOLERANCE
+        for ts, depth_ts in zip(rgb_timestamps[matched], depth_timestamps[cor_idx[matched]]):
+            self.rgb_to_depth_timestamps_correspondance_dict[f'{ts:012}.{rgb_input_format}'] = f'{depth_ts:012}.{depth_input_format}'
+
+        omitted = np.count_nonzero(~matched)
+        if omitted > 0:
+            print(f'Too big difference (>= {TIMESTAMPS_TOLERANCE} μs) to find correspondence for {omitted} of {len(rgb_timestamps)} rgb timestamps, '
+                  f'they are omitted (max difference {diff[~matched].max()} μs, first omitted {rgb_timestamps[~matched][0]:012})')
+
+    def read_pair(self, rgb_name, depth_name):
+        """
+        Returns depth and rgb images read by their file names.
+        :param rgb_name: file name of rgb image
+        :param depth_name: file name of depth image
+        """
+        img_rgb = cv2.imread(self.path_to_rgb_camera_images + rgb_name)
+        img_depth = cv2.imread(self.path_to_depth_camera_images + depth_name, cv2.IMREAD_UNCHANGED)
+        return img_depth, img_rgb
+
+    def depth2rgb_for_frame(self, rgb_name, depth_name):
+        """
+        Read one pair of input images by their file names and run depth2rgb_for_pair on them.
+        :param rgb_name: file name of rgb image
+        :param depth_name: file name of depth image
+        """
+        img_depth, img_rgb = self.read_pair(rgb_name, depth_name)
+        self.depth2rgb_for_pair(img_depth, img_rgb, timestamp_rgb = rgb_name.split('.')[0])
+
+    def depth2rgb_for_pairs(self, pairs, progress_bar=None):
+        """
+        Pipelined depth2rgb procedure for a list of pairs.
+        Reader threads decode images ahead, alignment runs in the calling thread and
+        writer threads encode and save results. OpenCV releases the GIL, so all three stages overlap.
+        Both queues are bounded, so memory doesn't grow when one stage is slower than others.
+        :param pairs: list of (rgb_name, depth_name)
+        :param progress_bar: tqdm progress bar updated for every saved pair
+        """
+        pairs = iter(pairs)
+        reads = deque()
+        writes = deque()
+
+        def wait_oldest_write():
+            # Frames are appended to output container in the order of pairs
+            rgb_name, write = writes.popleft()
+            frame = write.result()
+            if frame is not None:
+                self.output_container.append(frame)
+            if self.manifest is not None:
+                self.mark_done([rgb_name])
+            if progress_bar is not None:
+                progress_bar.update(1)
+
+        with ThreadPoolExecutor(self.readers) as read_executor, \
+             ThreadPoolExecutor(self.writers) as write_executor:
+            def read_next():
+                pair = next(pairs, None)
+                if pair is not None:
+                    reads.append((pair[0], read_executor.submit(self.read_pair, *pair)))
+
+            for _ in range(self.read_queue_depth):
+                read_next()
+
+            while reads:
+                rgb_name, read = reads.popleft()
+                img_depth, img_rgb = read.result()
+                read_next()
+
+                pcd_image, img_rgb_undistorted = self.align_pair(img_depth, img_rgb)
+                point_cloud = self.point_cloud_for_pair(img_rgb_undistorted)
+
+                if len(writes) >= self.write_queue_depth:
+                    wait_oldest_write()
+                writes.append((rgb_name, write_executor.submit(self.save_pair, pcd_image.copy(), img_rgb_undistorted,
+                                                               rgb_name.split('.')[0], point_cloud)))
+
+            while writes:
+                wait_oldest_write()
+
+    def params_hash(self):
+        """
+        Returns hash of everything except input images that output depends on.
+        """
+        params_hash = hashlib.sha1()
+        for array in (self.Kd, self.Dd, self.Kc, self.Dc, self.T):
+            params_hash.update(np.ascontiguousarray(array, dtype=np.float64).tobytes())
+        params_hash.update(f'{self.shape_d} {self.shape_c} {self.rgb_format} {self.depth_format} {self.point_cloud_params}'.encode())
+        return params_hash.hexdigest()
+
+    def pair_signature(self, rgb_name, depth_name):
+        """
+        Returns signature of input images of the pair, changes if any of them is replaced or rewritten.
+        """
+        rgb_stat = os.stat(self.path_to_rgb_camera_images + rgb_name)
+        depth_stat = os.stat(self.path_to_depth_camera_images + depth_name)
+        return f'{depth_name}:{rgb_stat.st_size}:{rgb_stat.st_mtime_ns}:{depth_stat.st_size}:{depth_stat.st_mtime_ns}'
+
+    def open_manifest(self, pairs):
+        """
+        Returns pairs that are not done yet according to the manifest of the output folder and opens the manifest
+        for marking newly done pairs. Manifest of a run with different params is discarded.
+        :param pairs: list of (rgb_name, depth_name)
+        """
+        params_hash = self.params_hash()
+        manifest_path = os.path.join(self.output_folder, MANIFEST_FILENAME)
+
+        done = {}
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                lines = [json.loads(line) for line in f if line.strip()]
+            if len(lines) > 0 and lines[0].get('params_hash') == params_hash:
+                # Later lines override earlier ones for reprocessed pairs
+                done = {line['rgb'] : line['signature'] for line in lines[1:]}
             else:
-                print(f'Too big difference ({np.abs(ts - depth_timestamps[cor_idx])} μs) to find correspondence, rgb timestamp {ts:012} is omitted')
+                print('Manifest params differ from current ones, all pairs will be processed')
+
+        self.pair_signatures = {rgb_name : self.pair_signature(rgb_name, depth_name) for rgb_name, depth_name in pairs}
+        todo = [(rgb_name, depth_name) for rgb_name, depth_name in pairs if done.get(rgb_name) != self.pair_signatures[rgb_name]]
+        done = {rgb_name : signature for rgb_name, signature in done.items() if self.pair_signatures.get(rgb_name) == signature}
+        print(f'{len(pairs) - len(todo)} of {len(pairs)} pairs are already done')
+
+        # Rewrite manifest with valid pairs only, so it doesn't grow with reruns
+        self.manifest = open(manifest_path, 'w')
+        self.manifest.write(json.dumps({'params_hash' : params_hash}) + '\n')
+        for rgb_name, signature in sorted(done.items()):
+            self.manifest.write(json.dumps({'rgb' : rgb_name, 'signature' : signature}) + '\n')
+        self.manifest.flush()
+        return todo
 
+    def mark_done(self, rgb_names):
+        for rgb_name in rgb_names:
+            self.manifest.write(json.dumps({'rgb' : rgb_name, 'signature' : self.pair_signatures[rgb_name]}) + '\n')
+        self.manifest.flush()
 
-    def depth2rgb_for_folder(self):
+    def close_manifest(self):
+        if self.manifest is not None:
+            self.manifest.close()
+            self.manifest = None
+
+    def depth2rgb_for_folder(self, workers=1, incremental=False):
+        """
+        depth2rgb procedure for all corresponding pairs of the folder.
+        :param workers: number of worker processes. Every output file depends on its own pair only,
+                        so the result doesn't depend on the number of workers
+        :param incremental: if True, pairs done by previous runs with the same params and unchanged input images
+                            are skipped according to the manifest of the output folder
+        """
         self.create_timestamps_correspondance_dict()
+        pairs = sorted(self.rgb_to_depth_timestamps_correspondance_dict.items())
+
+        if incremental:
+            if self.output_backend == 'chunks':
+                raise ValueError('Chunks output backend doesn\'t support incremental runs')
+            pairs = self.open_manifest(pairs)
+        try:
+            self.process_pairs(pairs, workers)
+        finally:
+            self.close_manifest()
+
+    def process_pairs(self, pairs, workers):
+        if self.output_backend == 'chunks':
+            if workers > 1:
+                raise ValueError('Chunks output backend supports only one worker')
+            # Color images are stored encoded by rgb_format, 'raw' keeps them as is
+            with FrameChunkWriter(self.output_folder,
+                                  depth_shape=self.shape_c,
+                                  color_shape=self.shape_c + (3,),
+                                  color_encoding=self.rgb_format) as self.output_container, \
+                 tqdm(total=len(pairs)) as progress_bar:
+                self.depth2rgb_for_pairs(pairs, progress_bar)
+            self.output_container = None
+            return
+
+        if workers <= 1:
+            with tqdm(total=len(pairs)) as progress_bar:
+                self.depth2rgb_for_pairs(pairs, progress_bar)
+            return
+
+        chunks = [pairs[i:i + FRAMES_PER_TASK] for i in range(0, len(pairs), FRAMES_PER_TASK)]
+        with Pool(workers, initializer=init_worker, initargs=(self.init_params,)) as pool, \
+             tqdm(total=len(pairs)) as progress_bar:
+            for rgb_names_done in pool.imap_unordered(depth2rgb_for_chunk, chunks):
+                if self.manifest is not None:
+                    self.mark_done(rgb_names_done)
+                progress_bar.update(len(rgb_names_done))
+
+
+class depth2rgb_multi:
+    """
+    Projects depth images of several cameras onto color images of several cameras of one recording.
+    Every depth frame is read and undistorted once and then projected into every target color camera,
+    so the cost grows with the number of cameras rather than the number of camera pairs.
+    """
+
+    def __init__(self, path,
+                 depth_cameras,
+                 rgb_cameras,
+                 path_to_extrinsics_set,
+                 output_folder,
+                 rgb_format,
+                 depth_format,
+                 fuse,
+                 png_compression=None,
+                 readers=2,
+                 writers=2,
+                 read_queue_depth=8,
+                 write_queue_depth=8):
+        """
+        :param path: path to the folder with all recordings (1m, 2s, 3s, ...), format: '.../folder_name/'
+        :param depth_cameras: names of depth camera folders, format: ['1m', '2s']
+        :param rgb_cameras: names of color camera folders, format: ['1m', '2s']
+        :param path_to_extrinsics_set: path to the folder with extrinsics between depth and rgb cameras
+                                       named as '{depth_camera}_{rgb_camera}.json'. Extrinsics of a camera
+                                       to itself are taken from its calib_params.json
+        :param fuse: if True, depths of all cameras are fused into one image per color frame keeping the nearest
+                     point, otherwise every depth camera is saved separately to 'depth_{depth_camera}' folder
+        :param readers: number of threads reading input images ahead of projection
+        :param writers: number of threads saving output images
+        :param read_queue_depth: max number of color frames read ahead of projection
+        :param write_queue_depth: max number of color frames waiting to be saved
+        """
+        self.path = path
+        self.depth_cameras = depth_cameras
+        self.rgb_cameras = rgb_cameras
+        self.output_folder = output_folder
+        self.rgb_format = rgb_format
+        self.depth_format = depth_format
+        self.fuse = fuse
+        self.readers = readers
+        self.writers = writers
+        self.read_queue_depth = read_queue_depth
+        self.write_queue_depth = write_queue_depth
+
+        # Undistortion maps and depth rays are computed once per camera and projection buffers once per pair
+        # of image shapes, only the depth-to-color projection is specific to every pair
+        shared_tables = {}
+        self.aligners = {}
+        for depth_camera in depth_cameras:
+            for rgb_camera in rgb_cameras:
+                if depth_camera == rgb_camera:
+                    path_to_extrinsics_params = path + rgb_camera + '/calib_params.json'
+                else:
+                    path_to_extrinsics_params = os.path.join(path_to_extrinsics_set, f'{depth_camera}_{rgb_camera}.json')
+                self.aligners[(depth_camera, rgb_camera)] = depth2rgb(
+                    path_to_depth_params=path + depth_camera + '/calib_params.json',
+                    path_to_rgb_params=path + rgb_camera + '/calib_params.json',
+                    path_to_extrinsics_params=path_to_extrinsics_params,
+                    path_to_rgb_camera_images=path + rgb_camera + '/color/',
+                    path_to_depth_camera_images=path + depth_camera + '/depth/',
+                    output_folder=output_folder,
+                    rgb_format=rgb_format,
+                    depth_format=depth_format,
+                    png_compression=png_compression,
+                    shared_tables=shared_tables)
+
+        for rgb_camera in rgb_cameras:
+            os.makedirs(os.path.join(output_folder, rgb_camera, 'color'), exist_ok=True)
+            depth_folders = ['depth'] if fuse else [f'depth_{depth_camera}' for depth_camera in depth_cameras]
+            for depth_folder in depth_folders:
+                os.makedirs(os.path.join(output_folder, rgb_camera, depth_folder), exist_ok=True)
 
-        for rgb_name, depth_name in tqdm(self.rgb_to_depth_timestamps_correspondance_dict.items()):
-            img_rgb = cv2.imread(self.path_to_rgb_camera_images + rgb_name)
-            img_depth = cv2.imread(self.path_to_depth_camera_images + depth_name, cv2.IMREAD_UNCHANGED)
-            self.depth2rgb_for_pair(img_depth, img_rgb, timestamp_rgb = rgb_name.split('.')[0])
+    def create_jobs(self):
+        """
+        Returns color frames to process sorted by timestamp as a list of (rgb_camera, rgb_name, {depth_camera: depth_name})
+        and number of usages of every depth frame as a dict {(depth_camera, depth_name): count}.
+        """
+        correspondences = {}
+        for rgb_camera in self.rgb_cameras:
+            for depth_camera in self.depth_cameras:
+                aligner = self.aligners[(depth_camera, rgb_camera)]
+                aligner.create_timestamps_correspondance_dict()
+                for rgb_name, depth_name in aligner.rgb_to_depth_timestamps_correspondance_dict.items():
+                    correspondences.setdefault((rgb_camera, rgb_name), {})[depth_camera] = depth_name
+
+        jobs = sorted(((rgb_camera, rgb_name, depth_names) for (rgb_camera, rgb_name), depth_names in correspondences.items()),
+                      key=lambda job: (int(job[1].split('.')[0]), job[0]))
+        usages = {}
+        for _, _, depth_names in jobs:
+            for depth_camera, depth_name in depth_names.items():
+                usages[(depth_camera, depth_name)] = usages.get((depth_camera, depth_name), 0) + 1
+        return jobs, usages
+
+    @staticmethod
+    def read_undistorted(path, read_flags, maps):
+        """
+        Returns image read from the path and undistorted by the maps. Maps are only read, so it is safe in several threads.
+        """
+        return cv2.remap(cv2.imread(path, read_flags), *maps, cv2.INTER_LINEAR)
+
+    @staticmethod
+    def save_images(images):
+        """
+        Save output images of one color frame.
+        :param images: list of (path, image, imwrite params)
+        """
+        for path, image, params in images:
+            cv2.imwrite(path, image, params)
+
+    def depth2rgb_for_recording(self):
+        """
+        Pipelined projection of all color frames like depth2rgb.depth2rgb_for_pairs.
+        Reader threads read and undistort color frames and depth frames which are not read for previous color frames,
+        projection runs in the calling thread, since aligners share projection buffers, and writer threads save results.
+        """
+        jobs, usages = self.create_jobs()
+        progress_bar = tqdm(total=len(jobs))
+        jobs = iter(jobs)
+        reads = deque()
+        writes = deque()
+
+        # Reads of undistorted depth frames waiting for the rest of their target color frames.
+        # Jobs are sorted by time, so only frames of the current sync moment stay here
+        depth_reads = {}
+
+        def get_undistorted_depth(depth_camera, depth_name):
+            key = (depth_camera, depth_name)
+            img_depth_undistorted = depth_reads[key].result()
+            usages[key] -= 1
+            if usages[key] == 0:
+                del depth_reads[key]
+            return img_depth_undistorted
+
+        def wait_oldest_write():
+            writes.popleft().result()
+            progress_bar.update(1)
+
+        with ThreadPoolExecutor(self.readers) as read_executor, \
+             ThreadPoolExecutor(self.writers) as write_executor, \
+             progress_bar:
+            def read_next():
+                job = next(jobs, None)
+                if job is None:
+                    return
+                rgb_camera, rgb_name, depth_names = job
+                for depth_camera, depth_name in depth_names.items():
+                    if (depth_camera, depth_name) not in depth_reads:
+                        aligner = self.aligners[(depth_camera, rgb_camera)]
+                        depth_reads[(depth_camera, depth_name)] = read_executor.submit(
+                            self.read_undistorted, aligner.path_to_depth_camera_images + depth_name, cv2.IMREAD_UNCHANGED, aligner.map_d)
+                aligner = self.aligners[(next(iter(depth_names)), rgb_camera)]
+                reads.append((job, read_executor.submit(self.read_undistorted, aligner.path_to_rgb_camera_images + rgb_name,
+                                                        cv2.IMREAD_COLOR, aligner.map_c)))
+
+            for _ in range(self.read_queue_depth):
+                read_next()
+
+            while reads:
+                (rgb_camera, rgb_name, depth_names), read = reads.popleft()
+                img_rgb_undistorted = read.result()
+                read_next()
+
+                timestamp_rgb = rgb_name.split('.')[0]
+                output_path = os.path.join(self.output_folder, rgb_camera)
+                images = []
+                fused_image = None
+
+                for depth_camera, depth_name in sorted(depth_names.items()):
+                    aligner = self.aligners[(depth_camera, rgb_camera)]
+                    pcd_image = aligner.project_depth(get_undistorted_depth(depth_camera, depth_name))
+
+                    if not self.fuse:
+                        # Projection buffer is reused by the next projection, so the writer gets a copy
+                        images.append((os.path.join(output_path, f'depth_{depth_camera}', timestamp_rgb + '.' + self.depth_format),
+                                       pcd_image.copy(), aligner.imwrite_params(self.depth_format)))
+                    elif fused_image is None:
+                        fused_image = pcd_image.copy()
+                    else:
+                        # Keep the nearest point among cameras, zero means no point
+                        np.copyto(fused_image, pcd_image, where=(fused_image == 0) | ((pcd_image > 0) & (pcd_image < fused_image)))
+
+                if self.fuse:
+                    images.append((os.path.join(output_path, 'depth', timestamp_rgb + '.' + self.depth_format),
+                                   fused_image, aligner.imwrite_params(self.depth_format)))
+                images.append((os.path.join(output_path, 'color', timestamp_rgb + '.' + self.rgb_format),
+                               img_rgb_undistorted, aligner.imwrite_params(self.rgb_format)))
+
+                if len(writes) >= self.write_queue_depth:
+                    wait_oldest_write()
+                writes.append(write_executor.submit(self.save_images, images))
+
+            while writes:
+                wait_oldest_write()
+
+
+# Aligner of a worker process, built once per process by init_worker
+worker_aligner = None
+
+def init_worker(init_params):
+    global worker_aligner
+    # Parallelism comes from processes, OpenCV threads would only oversubscribe cores
+    cv2.setNumThreads(1)
+    worker_aligner = depth2rgb(**init_params)
+
+def depth2rgb_for_chunk(pairs):
+    worker_aligner.depth2rgb_for_pairs(pairs)
+    return [rgb_name for rgb_name, _ in pairs]
 
 
 
@@ -268,9 +959,124 @@ def main():
     parser.add_argument('-overwriting',
                         action='store_true',
                         help='If activated, will remove contents of specified output folder before running')
+    parser.add_argument('--png_compression',
+                        dest='png_compression',
+                        type=int,
+                        help='PNG compression level of saved images from 0 to 9. By default OpenCV level is used')
+    parser.add_argument('--readers',
+                        dest='readers',
+                        type=int,
+                        default=2,
+                        help='Number of threads reading input images ahead of alignment')
+    parser.add_argument('--writers',
+                        dest='writers',
+                        type=int,
+                        default=2,
+                        help='Number of threads saving aligned images')
+    parser.add_argument('--read_queue_depth',
+                        dest='read_queue_depth',
+                        type=int,
+                        default=8,
+                        help='Max number of pairs read ahead of alignment')
+    parser.add_argument('--write_queue_depth',
+                        dest='write_queue_depth',
+                        type=int,
+                        default=8,
+                        help='Max number of aligned pairs waiting to be saved')
+    parser.add_argument('--incremental',
+                        action='store_true',
+                        help='If activated, pairs done by previous runs to the same output folder are skipped,\
+                         only new or changed input images are processed. Done pairs are stored in \'folder_name/manifest.jsonl\'')
+    parser.add_argument('--output_backend',
+                        dest='output_backend',
+                        type=str,
+                        choices=['files', 'chunks'],
+                        default='files',
+                        help='\'files\' saves two images per frame. \'chunks\' appends frames to large chunk files in the output folder:\
+                         raw uint16 depth, color encoded by --rgb_format (\'raw\' for no encoding) and a timestamp index.\
+                         Use utils.frame_chunks.FrameChunkReader to read them')
+    parser.add_argument('--point_cloud',
+                        action='store_true',
+                        help='If activated, colored point clouds in color camera frame are saved as binary PLY files\
+                         to \'folder_name/point_cloud/$.ply\' too')
+    parser.add_argument('--voxel_size',
+                        dest='voxel_size',
+                        type=float,
+                        help='Size of voxel grid to downsample point clouds, in depth units (mm). By default no downsampling')
+    parser.add_argument('--depth_range',
+                        dest='depth_range',
+                        type=float,
+                        nargs=2,
+                        help='Min and max depth of points kept in point clouds, in depth units (mm). By default all points are kept')
+    parser.add_argument('--multi',
+                        action='store_true',
+                        help='If activated, depth of every camera of the recording folder p is projected onto color images of every camera in one pass.\
+                         Output structure is \'folder_name/{rgb_camera}/color/$.png\' and \'folder_name/{rgb_camera}/depth/$.png\' if --fuse\
+                         or \'folder_name/{rgb_camera}/depth_{depth_camera}/$.png\' otherwise')
+    parser.add_argument('--depth_cameras',
+                        dest='depth_cameras',
+                        type=str,
+                        nargs='+',
+                        help='Names of depth camera folders for --multi mode, format: \'1m 2s\'. By default all cameras of p are used')
+    parser.add_argument('--rgb_cameras',
+                        dest='rgb_cameras',
+                        type=str,
+                        nargs='+',
+                        help='Names of color camera folders for --multi mode, format: \'1m 2s\'. By default all cameras of p are used')
+    parser.add_argument('--extr_set',
+                        dest='extr_set',
+                        type=str,
+                        help='Path to the folder with extrinsics for --multi mode, files are named as \'{depth_camera}_{rgb_camera}.json\'')
+    parser.add_argument('--fuse',
+                        action='store_true',
+                        help='If activated, --multi mode fuses depths of all cameras into one depth image per color image')
+    parser.add_argument('--workers',
+                        dest='workers',
+                        type=int,
+                        default=1,
+                        help='Number of processes aligning frames in parallel')
 
     args = parser.parse_args()
 
+    if args.multi:
+        if (args.rgb_camera is not None) | (args.depth_camera is not None) | (args.ex_params is not None):
+            raise ValueError("-c, -d, -e can't be used with --multi, use --rgb_cameras, --depth_cameras, --extr_set instead")
+        if (args.workers != 1) | args.incremental | (args.output_backend != 'files'):
+            raise ValueError("--workers, --incremental, --output_backend chunks can't be used with --multi")
+        if args.point_cloud | (args.voxel_size is not None) | (args.depth_range is not None):
+            raise ValueError("--point_cloud, --voxel_size, --depth_range can't be used with --multi")
+
+        cameras = sorted(name for name in os.listdir(args.p) if os.path.isfile(args.p + name + '/calib_params.json'))
+        depth_cameras = args.depth_cameras if args.depth_cameras is not None else cameras
+        rgb_cameras = args.rgb_cameras if args.rgb_cameras is not None else cameras
+        if (args.extr_set is None) & any(d != c for d in depth_cameras for c in rgb_cameras):
+            raise ValueError("--extr_set should be specified to project depth between different cameras")
+
+        output_folder = args.output_folder
+        if output_folder is None:
+            output_folder = args.p.split('/')[-2] + '_multi_aligned'
+        print(f'Output directory is: {output_folder}')
+
+        if os.path.exists(output_folder) & args.overwriting:
+            rmtree(output_folder)
+            print('Output directory will be overwrited')
+
+        aligner = depth2rgb_multi(path=args.p,
+                                  depth_cameras=depth_cameras,
+                                  rgb_cameras=rgb_cameras,
+                                  path_to_extrinsics_set=args.extr_set,
+                                  output_folder=output_folder,
+                                  rgb_format=args.rgb_format,
+                                  depth_format=args.depth_format,
+                                  fuse=args.fuse,
+                                  png_compression=args.png_compression,
+                                  readers=args.readers,
+                                  writers=args.writers,
+                                  read_queue_depth=args.read_queue_depth,
+                                  write_queue_depth=args.write_queue_depth)
+        aligner.depth2rgb_for_recording()
+        return
+
     if (args.p is not None) & (args.rgb_camera is not None) & (args.depth_camera is not None) & (args.ex_params is not None):
         path_to_depth_params = args.p + args.depth_camera + '/calib_params.json'
         path_to_rgb_params = args.p + args.rgb_camera + '/calib_params.json'
@@ -298,17 +1104,24 @@ def main():
 
     print(f'Output directory is: {output_folder}')
 
+    # Chunks output backend creates its files in the output folder itself
+    output_subfolders = ['color', 'depth'] if args.output_backend == 'files' else ['']
+    point_cloud_params = None
+    if args.point_cloud:
+        output_subfolders.append('point_cloud')
+        point_cloud_params = {'voxel_size' : args.voxel_size, 'depth_range' : args.depth_range}
+
     # If folder exists and overwriting is true than delete folder and create it again
     if os.path.exists(output_folder) & args.overwriting:
         rmtree(output_folder)
-        os.makedirs(output_folder + '/color')
-        os.makedirs(output_folder + '/depth')
+        for subfolder in output_subfolders:
+            os.makedirs(os.path.join(output_folder, subfolder))
         print('Output directory will be overwrited')
 
-    #If folder doen't exist, create it
-    elif not os.path.exists(output_folder):
-        os.makedirs(output_folder + '/color')
-        os.makedirs(output_folder + '/depth')
+    #If folder or some of its subfolders don't exist, create them
+    else:
+        for subfolder in output_subfolders:
+            os.makedirs(os.path.join(output_folder, subfolder), exist_ok=True)
 
     ########### Initialize rgb2depth procedure and run it ###########
     aligner = depth2rgb(path_to_depth_params=path_to_depth_params,
@@ -318,9 +1131,16 @@ def main():
                         path_to_depth_camera_images=path_to_depth_camera_images,
                         output_folder=output_folder,
                         rgb_format=rgb_format,
-                        depth_format=rgb_format)
+                        depth_format=rgb_format,
+                        png_compression=args.png_compression,
+                        readers=args.readers,
+                        writers=args.writers,
+                        read_queue_depth=args.read_queue_depth,
+                        write_queue_depth=args.write_queue_depth,
+                        output_backend=args.output_backend,
+                        point_cloud_params=point_cloud_params)
 
-    aligner.depth2rgb_for_folder()
+    aligner.depth2rgb_for_folder(workers=args.workers, incremental=args.incremental)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Simulator of mrob_recorder for testing recorder.py, server.py and streamer.py without Azure Kinect cameras.
+Set MROB_RECORDER to the path of this script to use it instead of the executable.
+
+Environment:
+  MROB_SIM_SERIALS     comma separated serial numbers of simulated cameras, serial numbers of DEFAULT_PARAMS by default
+  MROB_SIM_ARM_DELAY   seconds a subordinate takes to open its device before waiting for master
+  MROB_SIM_SYNC_FILE   file where master writes its start time, subordinates start capturing when it is newer than their own start
+  MROB_IMAGES_PATH     folder for latest frames of cameras, /mnt/mrob_tmpfs/images by default
+"""
+import argparse
+import io
+import os
+import signal
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+from params import DEFAULT_PARAMS
+from utils.benchmarks import COLOR_MODES, DEPTH_MODES, PASSIVE_IR_SHAPE
+
+IMAGES_PATH = os.environ.get('MROB_IMAGES_PATH', '/mnt/mrob_tmpfs/images')
+SYNC_FILE = os.environ.get('MROB_SIM_SYNC_FILE', '/tmp/mrob_sim_sync')
+ARM_DELAY = float(os.environ.get('MROB_SIM_ARM_DELAY', 0.5))
+SERIALS = os.environ.get('MROB_SIM_SERIALS', ','.join(cam['ser_num'] for cam in DEFAULT_PARAMS.values())).split(',')
+SYNC_POLL_INTERVAL = 0.005 # seconds
+
+DEPTH_MODES = {**DEPTH_MODES, 'PASSIVE_IR' : PASSIVE_IR_SHAPE}
+COLOR_BYTES_PER_PIXEL = 0.2 # size of MJPEG color frames in MKV
+SYNTHETIC_FRAMES = 8 # different frames cycled in tmpfs images
+
+stopping = False
+
+def handle_sigint(signum, frame):
+    global stopping
+    stopping = True
+
+def list_devices():
+    for index, serial in enumerate(SERIALS):
+        print(f'Index:{index}\tSerial:{serial}\tColor:1.6.110\tDepth:1.6.79')
+    if len(SERIALS) == 0:
+        print('No devices connected.')
+
+# Synthetic latest frames: color gradient JPEGs and depth ramps
+# Params: depth_shape, color_shape
+def synthetic_frames(depth_shape, color_shape):
+    colors = []
+    depths = []
+    h, w = color_shape
+    gradient = (np.arange(w)[None, :] * 255 // w + np.arange(h)[:, None] * 255 // h) // 2
+    for i in range(SYNTHETIC_FRAMES):
+        image = np.stack([gradient, np.roll(gradient, i * w // SYNTHETIC_FRAMES, axis=1), np.full_like(gradient, i * 32)], axis=-1)
+        output = io.BytesIO()
+        Image.fromarray(image.astype(np.uint8)).save(output, format='JPEG', quality=80)
+        colors.append(output.getvalue())
+        h_d, w_d = depth_shape
+        depth = 500 + (np.arange(w_d)[None, :] * 3000 // w_d + np.zeros((h_d, 1), dtype=np.int64) + i * 100) % 3500
+        depths.append(depth.astype(np.uint16).tobytes())
+    return colors, depths
+
+# Replace file content at once, so readers never see a partially written frame.
+# Folder is created again if tmpfs images are cleaned up while recording
+# Params: path, data
+def write_latest(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(path + '.tmp', path)
+
+# Wait for start time of master newer than start of this subordinate, like sync pulses of master started after subordinate
+# Params: start_time_ns
+def wait_for_master(start_time_ns):
+    while not stopping:
+        try:
+            with open(SYNC_FILE) as f:
+                if int(f.read() or 0) > start_time_ns:
+                    return True
+        except (FileNotFoundError, ValueError):
+            pass
+        time.sleep(SYNC_POLL_INTERVAL)
+    return False
+
+def record(args):
+    start_time_ns = time.time_ns()
+    serial = SERIALS[args.device]
+    depth_shape = DEPTH_MODES[args.depth_mode]
+    color_shape = COLOR_MODES[args.color_mode]
+    print(f'Device serial number: {serial}', flush=True)
+
+    # Opening the device. Frames are built meanwhile, so that capture starts right after sync
+    colors, depths = synthetic_frames(depth_shape, color_shape)
+    color_path = os.path.join(IMAGES_PATH, serial, 'color')
+    depth_path = os.path.join(IMAGES_PATH, serial, 'depth')
+    os.makedirs(color_path, exist_ok=True)
+    os.makedirs(depth_path, exist_ok=True)
+    # MKV grows by a compressed color frame and a raw depth frame per capture
+    mkv_frame = bytes(int(color_shape[0] * color_shape[1] * COLOR_BYTES_PER_PIXEL) + depth_shape[0] * depth_shape[1] * 2)
+    time.sleep(max(0, ARM_DELAY - (time.time_ns() - start_time_ns) / 1e9))
+    if args.external_sync.lower() == 'subordinate':
+        print('[subordinate mode] Waiting for signal from master', flush=True)
+        if not wait_for_master(start_time_ns):
+            return
+    elif args.external_sync.lower() == 'master':
+        write_latest(SYNC_FILE, str(time.time_ns()).encode('utf-8'))
+    print('Started recording', flush=True)
+
+    period = 1 / args.rate
+    first_frame_time = time.monotonic()
+    frame = 0
+    with open(args.output, 'wb') as mkv, open(args.timestamps_table, 'w') as csv:
+        csv.write('frame,color_timestamp_us,depth_timestamp_us,system_time_ns\n')
+        while not stopping:
+            timestamp = int(frame * period * 1e6)
+            depth_timestamp = timestamp + args.depth_delay
+            mkv.write(mkv_frame)
+            mkv.flush()
+            csv.write(f'{frame},{timestamp},{depth_timestamp},{time.time_ns()}\n')
+            csv.flush()
+            write_latest(os.path.join(color_path, '0.jpg'), colors[frame % SYNTHETIC_FRAMES])
+            write_latest(os.path.join(depth_path, '0.bin'), depths[frame % SYNTHETIC_FRAMES])
+            print(f'Color timestamp: {timestamp} Depth timestamp: {depth_timestamp}', flush=True)
+            frame += 1
+            time.sleep(max(0, first_frame_time + frame * period - time.monotonic()))
+    print('Stopping recording', flush=True)
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulator of mrob_recorder writing synthetic recordings. No cameras are needed.')
+    parser.add_argument('--list', action='store_true', help='List simulated devices')
+    parser.add_argument('--device', type=int, default=0)
+    parser.add_argument('--external-sync', dest='external_sync', type=str, default='Standalone')
+    parser.add_argument('--sync-delay', dest='sync_delay', type=int, default=0)
+    parser.add_argument('--depth-delay', dest='depth_delay', type=int, default=0)
+    parser.add_argument('--depth-mode', dest='depth_mode', type=str, choices=list(DEPTH_MODES.keys()), default='NFOV_UNBINNED')
+    parser.add_argument('--color-mode', dest='color_mode', type=str, choices=list(COLOR_MODES.keys()), default='1080p')
+    parser.add_argument('--rate', type=int, default=30)
+    parser.add_argument('--exposure-control', dest='exposure_control', type=int)
+    parser.add_argument('--save-all-captures', dest='save_all_captures', type=str)
+    parser.add_argument('output', type=str, nargs='?', help='Output MKV file')
+    parser.add_argument('timestamps_table', type=str, nargs='?', help='Output CSV table of timestamps')
+    args = parser.parse_args()
+
+    if args.list:
+        list_devices()
+        return
+    if args.output is None or args.timestamps_table is None:
+        parser.error('output and timestamps_table are required for recording')
+    if not 0 <= args.device < len(SERIALS):
+        print(f'Error: device {args.device} is not connected', file=sys.stderr)
+        sys.exit(1)
+
+    signal.signal(signal.SIGINT, handle_sigint)
+    record(args)
+
+if __name__ == '__main__':
+    main()
@@ -8,18 +8,31 @@ import time
 import shutil
 import json
 import argparse
+import threading
 import requests
+from concurrent.futures import ThreadPoolExecutor
 
-from utils.utils import bcolors
+from utils.utils import bcolors, sizeof_fmt
+from utils.recorder_monitor import RecorderMonitor, follow_output, line_buffered, recording_metrics
+from utils.session_manifest import MANIFEST_FILENAME, StreamingHasher, follow_file, write_manifest
 from params import *
 
 LITERALS_DEFAULT = "def"
 LITERALS_NONE = "none"
 
 TIMEOUT = 2
+LIST_TIMEOUT = 10 # camera enumeration takes several seconds
+MAX_NODE_WORKERS = 32 # nodes called at the same time
+READY_TIMEOUT = 15 # seconds for subordinates to be armed before master is started
+MONITOR_INTERVAL = 1 # seconds between checks of running recordings
+STALL_TIMEOUT = 10 # seconds without MKV growth after which a recording is considered stalled
+MIN_DISK_FREE = 2 * 1024 ** 3 # bytes, recording is stopped when less space is left
+STOP_TIMEOUT = 10 # seconds for local recorders to finalize MKV files
+OUTPUT_TAIL = 5 # last output lines printed for a failed recording
 
 this_file_path = os.path.dirname(os.path.abspath(__file__))
-executable = os.path.join(this_file_path, 'Azure-Kinect-Sensor-SDK/build/bin/mrob_recorder')
+# MROB_RECORDER may point to another executable, e.g. mrob_recorder_sim.py
+executable = os.environ.get('MROB_RECORDER', os.path.join(this_file_path, 'Azure-Kinect-Sensor-SDK/build/bin/mrob_recorder'))
 
 def print_master(*objects, sep=' ', end='\n', file=sys.stdout, flush=False, print_preword=True):
     print(bcolors.BOLD + bcolors.OKGREEN + ('MASTER MESSAGE: ' if print_preword else ''), end='', file=file, flush=flush)
@@ -32,6 +45,23 @@ def print_master(*objects, sep=' ', end='\n', file=sys.stdout, flush=False, prin
 def print_master_error(string):
     print(bcolors.BOLD + bcolors.FAIL + 'MASTER ERROR: ' + string + bcolors.ENDC)
 
+# Nodes are called concurrently over keep-alive sessions, one session per node address
+node_sessions = {}
+node_executor = ThreadPoolExecutor(max_workers=MAX_NODE_WORKERS)
+
+def node_session(address):
+    if address not in node_sessions:
+        node_sessions[address] = requests.Session()
+    return node_sessions[address]
+
+# Call function for every node concurrently, so the slowest node rather than the sum of all nodes sets the latency
+# Params: function, addresses
+def fan_out(function, addresses):
+    for address in addresses: # sessions are created before threads use them
+        node_session(address)
+    return list(node_executor.map(function, addresses))
+# Return: results in order of addresses
+
 # Check master camera setup
 # Params: cams
 def get_predefined_master_cam_sticker(cams):
@@ -63,12 +93,12 @@ def get_predefined_master_cam_sticker(cams):
 def get_distributed_connected_camera_list(cams):
     connected_camera_list = ''
     predef_addresses = [cams[cam_sticker]['address'] for cam_sticker in cams.keys()] # Parse predefined serial numbers
-    predef_addresses = set(predef_addresses)
-    for address in predef_addresses:
-        response = requests.get(f'http://{address}get_connected_camera_list', stream=True)
+    predef_addresses = sorted(set(predef_addresses))
+    def get_camera_list(address):
+        response = node_session(address).get(f'http://{address}get_connected_camera_list', timeout=LIST_TIMEOUT)
         check_response(response, address)
-        text = response.json()
-        text = text['connected_camera_list']
+        return response.json()['connected_camera_list']
+    for address, text in zip(predef_addresses, fan_out(get_camera_list, predef_addresses)):
         if 'No devices connected.' in text:
             print_master_error(f'No connected cameras in {address}. Exit')
             sys.exit()
@@ -242,17 +272,170 @@ def check_response(x, address):
         print_master_error(f'Response code from {address} is {x}. Exit')
         sys.exit()
 
-def check_distributed_recording_status(address):
-    response = requests.get(f'http://{address}get_recording_status', stream=True)
+def get_distributed_recording_metrics(address):
+    try:
+        response = node_session(address).get(f'http://{address}get_recording_metrics', timeout=TIMEOUT)
+    except requests.RequestException:
+        return None
+    if response.status_code != 200:
+        return None
+    return response.json()
+
+def get_distributed_recorder_output(address, filename):
+    try:
+        response = node_session(address).get(f'http://{address}get_recorder_output', params={'filename' : filename, 'lines' : OUTPUT_TAIL}, timeout=TIMEOUT)
+        return response.json()['output']
+    except (requests.RequestException, ValueError, KeyError):
+        return []
+
+printed_table_lines = 0
+
+# Print lines over the previously printed table
+# Params: lines
+def print_table(lines):
+    global printed_table_lines
+    if printed_table_lines > 0:
+        print(f'\033[{printed_table_lines}F', end='') # move cursor to the first line of the previous table
+    for line in lines:
+        print('\033[K' + line)
+    printed_table_lines = len(lines)
+
+# Time of the last response of every node, a node is considered failed only after it is silent for STALL_TIMEOUT,
+# so a single lost or slow status poll doesn't stop the recording
+last_response_times = {}
+
+# Check metrics of recordings of every node, print them as a table. Local recordings are checked the same way as distributed ones
+# Params: metrics
+def check_recording_metrics(metrics):
+    lines = []
+    failures = []
+    for address, recordings in metrics.items():
+        now = time.monotonic()
+        if recordings is None:
+            silent_s = now - last_response_times.setdefault(address, now)
+            lines.append(f'{address:>21} does not respond for {silent_s:.0f} s')
+            if silent_s > STALL_TIMEOUT:
+                failures.append((address, None, f'node does not respond for {silent_s:.0f} s'))
+            continue
+        last_response_times[address] = now
+        for filename, m in recordings.items():
+            size = sizeof_fmt(m['mkv_file_size']) if m['mkv_file_size'] is not None else '--'
+            rate = sizeof_fmt(m['mkv_write_rate']) + '/s' if m['mkv_write_rate'] is not None else '--'
+            lines.append(f'{address:>21} {filename:>8} {size:>9} {rate:>11}  captures {m["captures"]:>6}  drops {m["drops"]:>4}  '
+                         f'sync warnings {m["sync_warnings"]:>4}  errors {m["errors"]:>4}  disk free {sizeof_fmt(m["disk_free"]):>8}')
+            if not m['recording_is_running']:
+                failures.append((address, filename, f'recorder exited with code {m["returncode"]}'))
+            elif m['seconds_since_growth'] > STALL_TIMEOUT:
+                failures.append((address, filename, f'MKV has not grown for {m["seconds_since_growth"]:.0f} s'))
+            if m['disk_free'] < MIN_DISK_FREE:
+                failures.append((address, filename, f'only {sizeof_fmt(m["disk_free"])} of disk space is left'))
+    print_table(lines)
+    return failures
+# Return: failures as (address, filename, description)
+
+
+# Wait till local subordinate recorders report they are armed
+# Params: processes, monitors, cmd_lines
+def wait_local_subordinates_ready(processes, monitors, cmd_lines):
+    deadline = time.monotonic() + READY_TIMEOUT
+    not_ready = []
+    for p, monitor, cmd_line in zip(processes, monitors, cmd_lines):
+        while not monitor.wait_ready(min(0.1, max(0, deadline - time.monotonic()))):
+            if p.poll() is not None or time.monotonic() > deadline: # exited or timed out
+                not_ready.append(cmd_line.split()[-2])
+                break
+    return not_ready
+# Return: not_ready
+
+# Wait till subordinate recorders of every node report they are armed
+# Params: addresses
+def wait_distributed_subordinates_ready(addresses):
+    def wait_node_ready(address):
+        try:
+            response = node_session(address).get(f'http://{address}wait_recorders_ready', params={'timeout' : READY_TIMEOUT},
+                                                 timeout=READY_TIMEOUT + TIMEOUT)
+        except requests.RequestException as e:
+            print_master_error(f'No response from {address}: {e}')
+            return [address]
+        check_response(response, address)
+        return [f'{filename} on {address}' for filename in response.json()['not_ready']]
+    return sum(fan_out(wait_node_ready, addresses), [])
+# Return: not_ready
+
+# Launch recorder on a node
+# Params: address, cmd_line, file_base_name
+def launch_remote_recorder(address, cmd_line, file_base_name):
+    data = {'cmd_line' : cmd_line, 'file_base_name' : file_base_name}
+    response = node_session(address).post(f'http://{address}launch_recorder', json=data, timeout=TIMEOUT)
     check_response(response, address)
-    data = response.json()
-    for filename in data.keys():
-        if not data[filename]['recording_is_running']:
-            filename_ = filename.split('.')[0]
-            print_master_error(f'Recording of camera {filename_} on address {address} is not running. Exit')
-            sys.exit()
-        print_master(f'{filename}:', data[filename]['mkv_file_size'], end=' ', print_preword=False)
 
+# Start local recorder with output followed by its monitor
+# Params: cmd_line, echo
+def launch_local_recorder(cmd_line, echo):
+    p = subprocess.Popen(line_buffered([executable] + cmd_line.split()), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    monitor = RecorderMonitor()
+    follow_output(p.stdout, monitor, echo)
+    return p, monitor
+# Return: p, monitor
+
+# Stop local recorders and wait till they finalize MKV files
+# Params: processes, signal_processes
+def stop_local_recorders(processes, signal_processes=True):
+    for p in processes:
+        if signal_processes and p.poll() is None:
+            p.send_signal(signal.SIGINT)
+    for p in processes:
+        try:
+            p.wait(timeout=STOP_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            print_master_error(f'Recorder {p.args[-2]} is not stopped in {STOP_TIMEOUT} s')
+
+# Finish hashing of local recordings and write manifest of the session into the current folder
+# Params: hashers, hashing_done, cams
+def write_local_manifest(hashers, hashing_done, cams):
+    hashing_done.set()
+    manifest = write_manifest('.', hashers, cams)
+    print_master(f'Manifest of {len(manifest["files"])} files is written to {MANIFEST_FILENAME}')
+
+# Wait till every node writes manifest of its recordings, write their files into manifest of the session in the current folder.
+# When recordings of all nodes are moved to a single path, they are verified by this manifest
+# Params: addresses, cams
+def write_distributed_manifest(addresses, cams):
+    def get_session_manifest(address):
+        try:
+            response = node_session(address).get(f'http://{address}get_session_manifest', params={'timeout' : STOP_TIMEOUT},
+                                                 timeout=STOP_TIMEOUT + TIMEOUT)
+            return response.json()['manifest']
+        except (requests.RequestException, ValueError, KeyError):
+            return None
+    files = {}
+    nodes = {}
+    for address, manifest in zip(addresses, fan_out(get_session_manifest, addresses)):
+        if manifest is None:
+            print_master_error(f'No manifest of recordings on {address}')
+            continue
+        files.update(manifest['files'])
+        nodes[address] = sorted(manifest['files'].keys())
+    with open(MANIFEST_FILENAME, 'w') as f:
+        json.dump({'created' : time.strftime('%Y-%m-%d-%H-%M-%S'), 'params' : cams, 'files' : files, 'nodes' : nodes}, f, indent=2)
+    print_master(f'Manifest of {len(files)} files is written to {MANIFEST_FILENAME}')
+
+# Stop recorders of a node, returns error if the node doesn't respond or fails to stop them
+# Params: address
+def stop_remote_recorder(address):
+    try:
+        response = node_session(address).get(f'http://{address}stop_recorder', timeout=TIMEOUT)
+    except requests.RequestException as e:
+        return e
+    if response.status_code != 200:
+        return f'response code is {response.status_code}'
+
+# Stop recorders of every node at about the same time, a node without response doesn't delay the others
+# Params: addresses
+def stop_distributed_recorders(addresses):
+    for address, error in zip(addresses, fan_out(stop_remote_recorder, addresses)):
+        if error is not None:
+            print_master_error(f'Recorder on {address} is not stopped: {error}')
 
 def main():
     argument_parser = argparse.ArgumentParser("Recorder script")
@@ -301,51 +484,93 @@ def main():
     with open('recording_params.json', 'w') as fp:
         json.dump(cams, fp)
 
-    def launch_remote_recorder(address, cmd_line, file_base_name):
-        data = {'cmd_line' : cmd_line, 'file_base_name' : file_base_name}
-        response = requests.post(f'http://{address}launch_recorder', json=data, timeout=TIMEOUT)
-        check_response(response, address)
-
     # Launch recording from Subordinate cameras
+    # Output of local recorders is followed by monitors and printed till the recording table is shown
+    echo = threading.Event()
+    echo.set()
     if not distributed: 
         subordinate_processes = []
+        subordinate_monitors = []
         for subordinate_cmd_line in subordinate_cmd_lines:
-            p = subprocess.Popen([executable] + subordinate_cmd_line.split())
+            p, monitor = launch_local_recorder(subordinate_cmd_line, echo)
             subordinate_processes.append(p)
+            subordinate_monitors.append(monitor)
     else:
+        # Several subordinates on one node are launched one by one, nodes are launched concurrently
+        cmd_lines = collections.defaultdict(list)
         for cmd_line, address in zip(subordinate_cmd_lines, subordinate_addresses):
-            launch_remote_recorder(address, cmd_line, file_base_name)
-            #time.sleep(0.1)
-
-    # Wait till Subordinate cameras start before Master camera
-    time.sleep(2)
+            cmd_lines[address].append(cmd_line)
+        def launch_node_recorders(address):
+            for cmd_line in cmd_lines[address]:
+                launch_remote_recorder(address, cmd_line, file_base_name)
+        fan_out(launch_node_recorders, list(cmd_lines.keys()))
+
+    # Wait till Subordinate cameras are armed before Master camera, otherwise its first sync pulses are missed
+    start = time.monotonic()
+    if not distributed:
+        not_ready = wait_local_subordinates_ready(subordinate_processes, subordinate_monitors, subordinate_cmd_lines)
+    else:
+        not_ready = wait_distributed_subordinates_ready(list(cmd_lines.keys()))
+    if len(not_ready) > 0:
+        print_master_error(f'Subordinate cameras are not ready for sync in {READY_TIMEOUT} s: ' + ', '.join(not_ready) + '. Exit')
+        if not distributed:
+            stop_local_recorders(subordinate_processes)
+        else:
+            stop_distributed_recorders(list(cmd_lines.keys()))
+        sys.exit()
+    print_master(f'Subordinate cameras are ready for sync in {time.monotonic() - start:.2f} s')
 
     if not distributed: 
-        master_process = subprocess.Popen([executable] + master_cmd_line.split())
+        master_process, master_monitor = launch_local_recorder(master_cmd_line, echo)
+        recordings = {cmd_line.split()[-2] : (p, monitor) for cmd_line, p, monitor in
+                      zip(subordinate_cmd_lines + [master_cmd_line], subordinate_processes + [master_process], subordinate_monitors + [master_monitor])}
+        # MKV files are hashed while they grow, so the manifest is written in seconds after stop
+        hashers = {filename : StreamingHasher(filename) for filename in recordings.keys()}
+        hashing_done = threading.Event()
+        for hasher in hashers.values():
+            follow_file(hasher, hashing_done)
     else:
         launch_remote_recorder(master_address, master_cmd_line, file_base_name)
 
-    addresses = set(subordinate_addresses + [master_address])
+    addresses = sorted(set(subordinate_addresses + [master_address]))
 
     # Handle keyboard interrupt
     print()
-    count = 0
     try:
         while True:
-            time.sleep(3)
-            count+=1
+            time.sleep(MONITOR_INTERVAL)
+            echo.clear()
+            # Local and distributed recordings are checked the same way by metrics of every recording
             if distributed: 
-                #print_master(count, end=' ')
-                for address in addresses:
-                    check_distributed_recording_status(address)
-                print(end='\r')
+                metrics = dict(zip(addresses, fan_out(get_distributed_recording_metrics, addresses)))
+            else:
+                metrics = {'local' : {filename : recording_metrics(p.poll(), monitor, filename) for filename, (p, monitor) in recordings.items()}}
+            failures = check_recording_metrics(metrics)
+
+            if len(failures) > 0:
+                for address, filename, failure in failures:
+                    print_master_error(f'{filename} on {address}: {failure}' if filename is not None else f'{address}: {failure}')
+                    if filename is not None:
+                        output = get_distributed_recorder_output(address, filename) if distributed else recordings[filename][1].lines(OUTPUT_TAIL)
+                        print('\n'.join(output))
+                print_master_error('Stop recording. Exit')
+                if distributed:
+                    stop_distributed_recorders(addresses)
+                    write_distributed_manifest(addresses, cams)
+                else:
+                    stop_local_recorders([p for p, _ in recordings.values()])
+                    write_local_manifest(hashers, hashing_done, cams)
+                sys.exit()
 
     except KeyboardInterrupt:
         if distributed:
-            for address in addresses:
-                requests.get(f'http://{address}stop_recorder', stream=True, timeout=TIMEOUT)
+            stop_distributed_recorders(addresses)
+            write_distributed_manifest(addresses, cams)
         else:
-            time.sleep(2) # needed to finalize stdouts before entire exit
+            # Recorders got SIGINT from terminal too, their final messages are printed while they finalize files
+            echo.set()
+            stop_local_recorders([p for p, _ in recordings.values()], signal_processes=False)
+            write_local_manifest(hashers, hashing_done, cams)
         print()
 
 if __name__ == '__main__':
@@ -1,58 +1,156 @@
-from fastapi import FastAPI, Response
+from fastapi import FastAPI, Header, Query, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi.encoders import jsonable_encoder
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 
 
+import asyncio
 import subprocess
 import shutil
 import os
-import glob
 import time
 import signal
+from typing import List
 from utils.utils import *
+from utils.frame_index import LatestFrameIndex
+from utils.previews import DEPTH_RANGE_DEFAULT, PreviewCache, encode_preview
+from utils.recorder_monitor import RecorderMonitor, RATE_INTERVAL, line_buffered, recording_metrics
+from utils.session_manifest import StreamingHasher, write_manifest
 
 WATCHDOG_TIMEOUT = 10 # seconds
-TEMP_IMAGES_PATH = '/mnt/mrob_tmpfs/images/'
+DEVICE_LIST_TTL = 5 # seconds
+READY_TIMEOUT = 15 # seconds
+READY_POLL_INTERVAL = 0.02 # seconds
+TEMP_IMAGES_PATH = os.path.join(os.environ.get('MROB_IMAGES_PATH', '/mnt/mrob_tmpfs/images'), '')
+FRAME_INDEX_INTERVAL = 0.01 # seconds, about a third of frame period at 30 fps
+STREAM_MAX_RATE = 30 # frames per second
+PREVIEW_CACHE_SIZE = 32 # encoded previews
+PREVIEW_QUALITY = 75 # default JPEG quality of previews
+STREAM_BOUNDARY = 'frame'
+IMAGE_MEDIA_TYPES = {'color' : 'image/jpeg', 'depth' : 'application/octet-stream'} # raw uint16 depth
 
 this_file_path = os.path.dirname(os.path.abspath(__file__))
-executable = os.path.join(this_file_path, 'Azure-Kinect-Sensor-SDK/build/bin/mrob_recorder')
+# MROB_RECORDER may point to another executable, e.g. mrob_recorder_sim.py
+executable = os.environ.get('MROB_RECORDER', os.path.join(this_file_path, 'Azure-Kinect-Sensor-SDK/build/bin/mrob_recorder'))
+records_path = os.environ.get('MROB_RECORDS_PATH', os.path.join(this_file_path, 'records'))
 
+# State of recorders of the current session, by their MKV filenames
+session_name = None
 processes = {}
+monitors = {} # health of recorder processes by their MKV filenames
+hashers = {} # streaming hashes of MKV files by their filenames
+cmd_lines = {} # command lines of recorders by their MKV filenames
+manifests = {} # manifests by session paths, None while it is written
 path = None
+event_loop = None # loop owning asyncio transports of recorders, set when they are launched
 
 app = FastAPI()
 
+# Device enumeration takes seconds, its result is reused until TTL expires or recorders are launched or stopped
+device_list = {'text' : None, 'time' : 0}
+device_list_lock = None # created in the event loop of the server
+
+def invalidate_device_list():
+    device_list['text'] = None
+
 @app.get("/get_connected_camera_list")
-def get_connected_camera_list():
+async def get_connected_camera_list():
     watchdog.reset()
-    connected_camera_list = subprocess.check_output([f'{executable}', '--list']).decode('utf-8') # Get connected camera list
+    global device_list_lock
+    if device_list_lock is None:
+        device_list_lock = asyncio.Lock()
+    async with device_list_lock: # concurrent requests share one enumeration
+        if device_list['text'] is None or time.monotonic() - device_list['time'] > DEVICE_LIST_TTL:
+            # Enumeration runs as a subprocess awaited by the event loop, so other requests are served meanwhile
+            list_process = await asyncio.create_subprocess_exec(executable, '--list', stdout=asyncio.subprocess.PIPE)
+            stdout, _ = await list_process.communicate()
+            if list_process.returncode != 0:
+                raise subprocess.CalledProcessError(list_process.returncode, [executable, '--list'], stdout)
+            device_list['text'] = stdout.decode('utf-8') # Get connected camera list
+            device_list['time'] = time.monotonic()
+        connected_camera_list = device_list['text']
     return {"connected_camera_list": connected_camera_list}
     #return connected_camera_list
 
+# Create session folder, tmpfs images are cleaned up only for a new session,
+# since recorders of the current one are already writing there
+# Params: file_base_name, new_session
+# Return: session path
+def prepare_session_folders(file_base_name, new_session):
+    if new_session and os.path.exists(TEMP_IMAGES_PATH):
+        shutil.rmtree(TEMP_IMAGES_PATH)
+    os.makedirs(TEMP_IMAGES_PATH, exist_ok=True)
+
+    session_path = os.path.join(records_path, file_base_name)
+    if not os.path.exists(session_path):
+        #shutil.rmtree(path)
+        os.makedirs(session_path)
+    return session_path
+
 @app.post("/launch_recorder")
 async def launch_recorder(data: dict):
     watchdog.reset()
+    invalidate_device_list()
 
-    global path
-    
-    if os.path.exists(TEMP_IMAGES_PATH):
-        shutil.rmtree(TEMP_IMAGES_PATH)
-    os.makedirs(TEMP_IMAGES_PATH)
-    
-    file_base_name = data['file_base_name']
-
-    path = os.path.join(this_file_path, 'records', file_base_name)
-    if not os.path.exists(path):
-        #shutil.rmtree(path)
-        os.makedirs(path)
-    os.chdir(path)
+    global path, event_loop, session_name
+    event_loop = asyncio.get_running_loop()
 
     arg_list = data['cmd_line'].split()
-    arg_list.insert(0, executable)
+    filename = arg_list[-2]
+    # MKV filenames are the same in every session, so recorders of the previous session are forgotten,
+    # otherwise they are waited for and reported as exited
+    new_session = data['file_base_name'] != session_name or filename in processes
+    if new_session:
+        for state in (processes, monitors, hashers, cmd_lines):
+            state.clear()
+        session_name = data['file_base_name']
+
+    # Filesystem calls run in a worker thread, so the event loop isn't blocked by removing old images
+    path = await run_in_threadpool(prepare_session_folders, data['file_base_name'], new_session)
 
-    p = subprocess.Popen(arg_list)#, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    # Recorder writes into the session folder given as its working directory, the server's one is not changed
+    p = await asyncio.create_subprocess_exec(*line_buffered([executable, *arg_list]), cwd=path,
+                                             stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
 
-    processes[arg_list[-2]] = p
+    processes[filename] = p
+    monitors[filename] = RecorderMonitor()
+    hashers[filename] = StreamingHasher(os.path.join(path, filename))
+    cmd_lines[filename] = data['cmd_line']
+    manifests.pop(path, None)
+    asyncio.ensure_future(read_recorder_output(p, monitors[filename]))
+    asyncio.ensure_future(sample_mkv_size(p, os.path.join(path, filename), monitors[filename], hashers[filename]))
+
+# Feed recorder output to its monitor until the recorder exits
+# Params: p, monitor
+async def read_recorder_output(p, monitor):
+    while True:
+        line = await p.stdout.readline()
+        if not line:
+            break
+        monitor.feed(line.decode('utf-8', errors='replace'))
+
+# Sample MKV file size for write rate and hash its new blocks while the recorder is running
+# Params: p, mkv_path, monitor, hasher
+async def sample_mkv_size(p, mkv_path, monitor, hasher):
+    while p.returncode is None:
+        try:
+            monitor.update_size(os.path.getsize(mkv_path))
+        except FileNotFoundError: # recorder hasn't created the file yet
+            pass
+        # Blocks are read in a worker thread shortly after they are written, while they are still in page cache
+        await run_in_threadpool(hasher.update)
+        await asyncio.sleep(RATE_INTERVAL)
+    await write_session_manifest(os.path.dirname(mkv_path))
+
+# Write manifest of a session when every its recorder has exited
+# Params: session_path
+async def write_session_manifest(session_path):
+    filenames = [filename for filename, hasher in hashers.items() if os.path.dirname(hasher.path) == session_path]
+    if len(filenames) == 0 or session_path in manifests or any(processes[filename].returncode is None for filename in filenames):
+        return
+    manifests[session_path] = None
+    manifests[session_path] = await run_in_threadpool(write_manifest, session_path, {filename : hashers[filename] for filename in filenames},
+                                                      {filename : cmd_lines[filename] for filename in filenames})
 
 @app.get("/get_recording_status")
 def get_recording_status():
@@ -60,42 +158,188 @@ def get_recording_status():
     data = {}
     for filename in processes.keys():
         mkv_path = os.path.join(path, filename)
-        data[os.path.basename(mkv_path)] = {'mkv_file_size' : sizeof_fmt(os.path.getsize(mkv_path)), 'recording_is_running' : processes[filename].poll() is None}
+        data[os.path.basename(mkv_path)] = {'mkv_file_size' : sizeof_fmt(os.path.getsize(mkv_path)), 'recording_is_running' : processes[filename].returncode is None}
     return data
 
-@app.get("/stop_recorder")
-def stop_recorder():
-    watchdog.stop()
+@app.get("/wait_recorders_ready")
+async def wait_recorders_ready(timeout: float = READY_TIMEOUT):
+    # Master is started when subordinates of every node are armed, this answers as soon as they are
+    watchdog.reset()
+    deadline = time.monotonic() + timeout
+    last_reset = time.monotonic()
+    while True:
+        not_ready = [filename for filename in processes.keys() if not monitors[filename].ready()]
+        exited = [filename for filename in not_ready if processes[filename].returncode is not None]
+        if len(not_ready) == 0 or len(exited) > 0 or time.monotonic() > deadline:
+            return {'ready' : len(not_ready) == 0, 'not_ready' : not_ready, 'exited' : exited}
+        if time.monotonic() - last_reset > 1: # waiting may be longer than watchdog timeout
+            watchdog.reset()
+            last_reset = time.monotonic()
+        await asyncio.sleep(READY_POLL_INTERVAL)
+
+@app.get("/get_recording_metrics")
+def get_recording_metrics():
+    watchdog.reset()
+    # Only recordings of the current session are reported, recorders of previous sessions are forgotten on launch
+    data = {}
     for filename in processes.keys():
-        p = processes[filename]
-        if p is not None:
+        data[filename] = recording_metrics(processes[filename].returncode, monitors[filename], hashers[filename].path)
+    return data
+
+@app.get("/get_recorder_output")
+def get_recorder_output(filename: str, lines: int = 50):
+    watchdog.reset()
+    if filename not in monitors:
+        return Response(status_code=404)
+    return {"output": monitors[filename].lines(lines)}
+
+# Send SIGINT to running recorders, must be called in the event loop since asyncio transports are not thread safe
+def signal_recorders():
+    for filename, p in processes.items():
+        if p.returncode is not None:
+            continue
+        try:
             p.send_signal(signal.SIGINT)
+        except ProcessLookupError: # exited before its return code is collected, the others are still signalled
+            pass
+
+@app.get("/stop_recorder")
+async def stop_recorder():
+    watchdog.stop()
+    invalidate_device_list()
+    signal_recorders()
+
+# Watchdog handler, the timer runs in its own thread and passes the stop to the event loop
+def stop_recorder_on_timeout():
+    invalidate_device_list()
+    if event_loop is not None:
+        event_loop.call_soon_threadsafe(signal_recorders)
+
+
+@app.get("/get_session_manifest")
+async def get_session_manifest(timeout: float = 0):
+    # Manifest is written after stop, watchdog is stopped by then and is not reset
+    deadline = time.monotonic() + timeout
+    while path is not None and manifests.get(path) is None and time.monotonic() < deadline:
+        await asyncio.sleep(READY_POLL_INTERVAL)
+    return {'manifest' : manifests.get(path)}
 
+# Preview endpoints are polled by viewers too, so they don't reset watchdog, otherwise an open viewer
+# would keep recording after the master has died. Only control requests of the master reset it
+@app.get("/get_camera_list")
+def get_camera_list():
+    # Cameras streaming to tmpfs have directories named by their serial numbers
+    return {"camera_list": frame_index.cameras()}
 
+# Return preview variant of frames requested by query parameters, None for original frames.
+# Depth range of colormap is a part of depth variants only
+# Params: kind, max_width, quality, grayscale, depth_range
+def preview_variant(kind, max_width, quality, grayscale, depth_range):
+    if max_width is None and quality is None and not grayscale and depth_range is None:
+        return None
+    if kind == 'depth':
+        depth_range = tuple(depth_range) if depth_range is not None else DEPTH_RANGE_DEFAULT
+    else:
+        depth_range = None
+    return (max_width, quality if quality is not None else PREVIEW_QUALITY, grayscale, depth_range)
+
+# Check query parameters common for frame requests
+# Params: camera, kind, max_width, quality, depth_range
+def is_valid_frame_request(camera, kind, max_width, quality, depth_range):
+    return kind in IMAGE_MEDIA_TYPES and (camera is None or os.path.basename(camera) == camera) and \
+           (max_width is None or max_width >= 16) and (quality is None or 1 <= quality <= 95) and \
+           (depth_range is None or (len(depth_range) == 2 and 0 <= depth_range[0] < depth_range[1] <= 65535))
+
+# Read frame file or get its cached preview variant, depth previews are colorized JPEGs
+# Params: latest, kind, variant
+# Return: content, media_type
+def read_frame(latest, kind, variant):
+    latest_image = latest[0]
+    def read():
+        # Frame is read at once, since recorder may rewrite the file while it is being sent
+        with open(latest_image, 'rb') as f:
+            return f.read()
+    if variant is None:
+        return read(), IMAGE_MEDIA_TYPES[kind]
+    # Preview is encoded once per frame and variant however many viewers request it
+    camera = latest_image.split('/')[-3]
+    return preview_cache.get((camera, kind, latest[:3], variant), lambda: encode_preview(read(), kind, *variant)), 'image/jpeg'
 
 @app.get("/get_last_image")
-def last_image():
-    watchdog.reset()
+def last_image(camera: str = None, kind: str = 'color', max_width: int = None, quality: int = None, grayscale: bool = False,
+               depth_range: List[int] = Query(None), if_none_match: str = Header(None)):
+    if not is_valid_frame_request(camera, kind, max_width, quality, depth_range):
+        return Response(status_code=400)
+    variant = preview_variant(kind, max_width, quality, grayscale, depth_range)
 
-    images_path = glob.glob(os.path.join(TEMP_IMAGES_PATH, '*', 'color'))
-    if len(images_path)==0:
+    latest = frame_index.get(camera, kind)
+    if latest is None:
         return
-    images_path = images_path[0]
+    latest_image, latest_creation_time, size, sequence = latest
+
+    # Poller that already has this frame gets an empty response
+    etag = f'"{latest_image.split("/")[-3]}-{kind}-{latest_creation_time}-{size}' + \
+           (f'-{variant[0]}-{variant[1]}-{int(variant[2])}' if variant is not None else '') + \
+           (f'-{variant[3][0]}-{variant[3][1]}"' if variant is not None and variant[3] is not None else '"')
+    headers = {'ETag' : etag, 'X-Frame-Sequence' : str(sequence),
+               'X-Frame-Time' : str(latest_creation_time), 'X-Server-Time' : str(time.time_ns())}
+    if if_none_match == etag:
+        return Response(status_code=304, headers=headers)
 
-    images = glob.glob(os.path.join(images_path, '*'))
-    if len(images)==0:
-        return
-    
-    creation_times = [os.stat(image).st_ctime_ns for image in images]
-    latest_creation_time = max(creation_times)
-    latest_image = images[creation_times.index(latest_creation_time)]
     metainfo = ''
     for item in latest_image.split('/')[-3:-1]:
         metainfo += f'{item}_' 
 
-    filename = f'{metainfo}{latest_creation_time}.jpg'
-    return FileResponse(path=latest_image, filename=filename, media_type='image/jpeg')
+    filename = f'{metainfo}{latest_creation_time}{os.path.splitext(latest_image)[1] if variant is None else ".jpg"}'
+    headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    try:
+        content, media_type = read_frame(latest, kind, variant)
+    except (OSError, SyntaxError, ValueError): # frame is removed or being rewritten
+        return
+    return Response(content=content, media_type=media_type, headers=headers)
+
+# Yield multipart parts with new frames of a camera stream no faster than max_rate.
+# Frames written while waiting for the rate limit or for a slow client are dropped, the client gets the latest one
+# Params: camera, kind, variant, max_rate
+async def frame_stream(camera, kind, variant, max_rate):
+    sent = None
+    next_time = 0
+    while True:
+        latest = frame_index.get(camera, kind)
+        if latest is None or latest[:3] == sent:
+            await asyncio.sleep(FRAME_INDEX_INTERVAL)
+            continue
+        delay = next_time - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+            continue
+        latest_image, latest_creation_time, _, sequence = latest
+        try:
+            # Preview encoding doesn't block other requests
+            content, media_type = await run_in_threadpool(read_frame, latest, kind, variant)
+        except (OSError, SyntaxError, ValueError):
+            await asyncio.sleep(FRAME_INDEX_INTERVAL)
+            continue
+        sent = latest[:3]
+        next_time = time.monotonic() + 1 / max_rate
+        header = f'--{STREAM_BOUNDARY}\r\nContent-Type: {media_type}\r\nContent-Length: {len(content)}\r\n' \
+                 f'X-Frame-Sequence: {sequence}\r\nX-Frame-Time: {latest_creation_time}\r\nX-Server-Time: {time.time_ns()}\r\n\r\n'
+        yield header.encode('utf-8') + content + b'\r\n'
+
+@app.get("/stream_images")
+def stream_images(camera: str = None, kind: str = 'color', max_width: int = None, quality: int = None, grayscale: bool = False,
+                  depth_range: List[int] = Query(None), max_rate: float = STREAM_MAX_RATE):
+    if not is_valid_frame_request(camera, kind, max_width, quality, depth_range) or max_rate <= 0:
+        return Response(status_code=400)
+    variant = preview_variant(kind, max_width, quality, grayscale, depth_range)
+
+    return StreamingResponse(frame_stream(camera, kind, variant, max_rate), media_type=f'multipart/x-mixed-replace; boundary={STREAM_BOUNDARY}')
+
 
+watchdog = Watchdog(WATCHDOG_TIMEOUT, stop_recorder_on_timeout)
+watchdog.stop()
 
-watchdog = Watchdog(WATCHDOG_TIMEOUT, stop_recorder)
-watchdog.stop()
\ No newline at end of file
+# Latest frames are indexed in background while they are requested, so requests don't depend on the number of files in tmpfs
+frame_index = LatestFrameIndex(TEMP_IMAGES_PATH, FRAME_INDEX_INTERVAL)
+frame_index.start()
+preview_cache = PreviewCache(PREVIEW_CACHE_SIZE)
@@ -3,77 +3,401 @@ import tkinter as tk
 from PIL import Image, ImageTk
 from itertools import cycle
 import numpy as np
+import math
+import os
 import sys
+import threading
+import time
 import argparse
+import io
+import requests
+import urllib3
+from collections import deque
+
+from params import DEFAULT_PARAMS
+from utils.previews import DEPTH_RANGE_DEFAULT, DEPTH_SHAPES, colorize_depth, depth_colormap_lut
 
 image_path = '/mnt/mrob_tmpfs/images'
-ids = ['000583592412', '000905794612', '000489713912']
+STREAMS = [('color', '0.jpg'), ('depth', '0.bin')] # stream directories of a camera and latest frame files in them
+
+WATCH_INTERVAL_S = 0.01 # how often frame files are checked for changes
+UI_REFRESH_MS = 20 # how often decoded frames are swapped into labels
+DISCOVERY_INTERVAL_MS = 1000 # how often camera directories are listed
+STATS_INTERVAL_MS = 500 # how often frame rates and ages are shown and logged
+FPS_WINDOW_S = 2 # frame rate is measured by frames written in this window
+REMOTE_TIMEOUT_S = 2 # timeout of requests to server.py of nodes
+COLOR_PREVIEW_WIDTH = 512 # width of color previews, height keeps aspect ratio of color mode
+DEPTH_DECIMATION = 2 # depth previews show every n-th pixel of every n-th row
+DEPTH_PREVIEW_WIDTH = 320 # width of remote depth previews, every second pixel of NFOV modes
+
+def read_depth(path, buffers):
+    """
+    Returns depth frame np.ndarray([h, w]) of uint16 read from raw file of mrob_recorder.
+    The array is a buffer reused for the next frame of the same file.
+    Shape is derived from the file size.
+    :param buffers: dict of buffers by path
+    """
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size not in DEPTH_SHAPES:
+            raise ValueError(f'Size {size} of {path} doesn\'t match any depth mode')
+        if path not in buffers or buffers[path].nbytes != size:
+            buffers[path] = np.empty(DEPTH_SHAPES[size], dtype=np.uint16)
+        if f.readinto(buffers[path]) != size:
+            raise ValueError(f'{path} is being rewritten')
+    return buffers[path]
+
+class FrameWatcher(threading.Thread):
+    """
+    Watches frame files written by mrob_recorder and decodes only changed ones off the UI thread.
+    A file is considered changed when its stat signature (mtime, size, inode) differs from the last decoded one,
+    which is a cheap check on tmpfs. Only the latest decoded frame of every file is kept.
+    Write times of frames are kept to measure frame rate.
+    """
+
+    def __init__(self, interval):
+        threading.Thread.__init__(self, daemon=True)
+        self.interval = interval
+        self.files = {} # key: (path, decode function)
+        self.signatures = {}
+        self.frame_times = {} # key: deque of mtimes of frames in the last FPS_WINDOW_S
+        self.ready = {} # key: (image, mtime)
+        self.lock = threading.Lock()
+
+    def watch(self, key, path, decode):
+        with self.lock:
+            self.files[key] = (path, decode)
+            self.frame_times[key] = deque()
+
+    def unwatch(self, key):
+        with self.lock:
+            for items in (self.files, self.signatures, self.frame_times, self.ready):
+                items.pop(key, None)
+
+    def pop_ready(self):
+        with self.lock:
+            ready, self.ready = self.ready, {}
+        return ready
+
+    def frame_rate(self, key):
+        """
+        Returns frame rate measured by write times of frames in the last FPS_WINDOW_S, None if there are not enough frames.
+        """
+        with self.lock:
+            frame_times = self.frame_times.get(key)
+            while frame_times and frame_times[0] < time.time_ns() - FPS_WINDOW_S * 1e9:
+                frame_times.popleft()
+            if frame_times is None or len(frame_times) < 2:
+                return None
+            return (len(frame_times) - 1) / (frame_times[-1] - frame_times[0]) * 1e9
+
+    def check(self, key, path, decode):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError: # camera hasn't written frames yet
+            return
+        signature = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        if self.signatures.get(key) == signature:
+            return
+        # Partially written frame is decoded again when writing finishes, since its signature changes
+        self.signatures[key] = signature
+        self.add_frame(key, stat.st_mtime_ns)
+        try:
+            image = decode(path)
+        except (OSError, SyntaxError, ValueError):
+            return
+        self.publish(key, image, stat.st_mtime_ns)
+
+    def add_frame(self, key, frame_time):
+        with self.lock:
+            frame_times = self.frame_times.get(key)
+            if frame_times is not None and (not frame_times or frame_times[-1] < frame_time):
+                frame_times.append(frame_time)
+
+    def publish(self, key, image, frame_time):
+        with self.lock:
+            if key in self.files:
+                self.ready[key] = (image, frame_time)
+
+    def run(self):
+        while True:
+            with self.lock:
+                files = list(self.files.items())
+            for key, (path, decode) in files:
+                self.check(key, path, decode)
+            time.sleep(self.interval)
+
+def multipart_parts(stream):
+    """
+    Yields (headers, content) of parts of multipart/x-mixed-replace stream of server.py, every part has Content-Length.
+    :param stream: binary file-like object of the response body
+    """
+    while True:
+        line = stream.readline()
+        if not line:
+            return
+        if not line.startswith(b'--'): # line break after the previous part
+            continue
+        headers = {}
+        while True:
+            line = stream.readline().strip()
+            if not line:
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip()] = value.strip()
+        length = int(headers['Content-Length'])
+        content = stream.read(length)
+        if len(content) < length: # connection is closed
+            return
+        yield headers, content
+
+class RemoteFrameWatcher(FrameWatcher):
+    """
+    Receives latest frames of cameras from MJPEG streams of server.py of several nodes and decodes them.
+    Every camera stream is received by its own thread over one long-lived connection, so server.py pushes
+    frames no faster than it rate-limits them instead of answering a poll for every check,
+    and a slow node doesn't delay frames of the others. Nodes are asked for their cameras once per interval.
+    Frame times are converted to the local clock by the server time sent with every frame.
+    """
+
+    def __init__(self, addresses, interval, params):
+        """
+        :param params: query parameters of previews by stream, server.py downscales color and colorizes depth
+        """
+        FrameWatcher.__init__(self, interval)
+        self.addresses = sorted(set(addresses))
+        self.params = params
+        self.camera_lists = {address : [] for address in self.addresses}
+
+    def cameras(self):
+        """
+        Returns dict of node addresses by serial numbers of cameras streaming on the nodes.
+        """
+        with self.lock:
+            return {serial : address for address, camera_list in self.camera_lists.items() for serial in camera_list}
+
+    def watch(self, key, path, decode):
+        FrameWatcher.watch(self, key, path, decode)
+        with self.lock:
+            watched = self.files[key]
+        threading.Thread(target=self.receive, args=(key, watched), daemon=True).start()
+
+    def is_watched(self, key, watched):
+        # Stream thread stops when its camera is removed, even if the camera is added again with a new thread
+        with self.lock:
+            return self.files.get(key) is watched
+
+    def receive(self, key, watched):
+        serial, stream = key
+        address, decode = watched
+        session = requests.Session()
+        while self.is_watched(key, watched):
+            try:
+                # Read timeout reconnects the stream if the camera stops writing frames
+                with session.get(f'http://{address}stream_images', params={'camera' : serial, 'kind' : stream, **self.params[stream]},
+                                 stream=True, timeout=REMOTE_TIMEOUT_S) as response:
+                    if response.status_code != 200:
+                        time.sleep(self.interval)
+                        continue
+                    for headers, content in multipart_parts(io.BufferedReader(response.raw)):
+                        if not self.is_watched(key, watched):
+                            return
+                        frame_time = int(headers['X-Frame-Time']) - int(headers['X-Server-Time']) + time.time_ns()
+                        self.add_frame(key, frame_time)
+                        try:
+                            image = decode(content)
+                        except (OSError, SyntaxError, ValueError):
+                            continue
+                        self.publish(key, image, frame_time)
+            except (requests.RequestException, urllib3.exceptions.HTTPError, OSError, ValueError, KeyError): # node is down or the stream is broken
+                time.sleep(self.interval)
+
+    def list_cameras(self, address):
+        session = requests.Session()
+        while True:
+            try:
+                camera_list = session.get(f'http://{address}get_camera_list', timeout=REMOTE_TIMEOUT_S).json()['camera_list']
+            except (requests.RequestException, ValueError, KeyError, TypeError): # node is down or isn't streaming
+                camera_list = []
+            with self.lock:
+                self.camera_lists[address] = camera_list
+            time.sleep(self.interval)
+
+    def run(self):
+        threads = [threading.Thread(target=self.list_cameras, args=(address,), daemon=True) for address in self.addresses]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
 
 class Application(tk.Tk):
 
-    def __init__(self, flip, *args, **kwargs):
+    def __init__(self, flip, depth_range=DEPTH_RANGE_DEFAULT, path=image_path, log_path=None, addresses=None, *args, **kwargs):
         tk.Tk.__init__(self, *args, **kwargs)
 
         self.flip = flip
+        self.path = path
+        self.depth_lut = depth_colormap_lut(depth_range)
+        self.depth_buffers = {}
 
         self.title('mrob_viewer')
-        self.geometry("836x870")
-        self.resizable(width=False, height=False)
-        #self.label = tk.Label(self)
-        #self.label.pack()
-
-        self.labels = []
-        self.images = [[None, None], [None, None], [None, None]]
-        for row in range(1,3+1):
-            temp = []
-            for column in range(1,2+1):
-                label = tk.Label(self)
-                label.grid(row=row, column=column)   
-                temp.append(label)
-            self.labels.append(temp)
-
-        self.duration_ms = 100
+
+        # Camera cells by serial number, cameras are discovered as directories of path
+        # or pulled from server.py of nodes with addresses
+        self.cameras = {}
+
+        self.duration_ms = UI_REFRESH_MS
         self.n = 1
 
-    def rescale(self, array):
-        out = 255.0 / (array.max() - array.min()) * (array - array.min())
-        return out.astype(np.uint8)
+        # Decoding runs in the watcher thread, UI thread only swaps finished images into labels
+        if addresses is None:
+            self.watcher = FrameWatcher(WATCH_INTERVAL_S)
+            self.decoders = {'color' : self.prepare_color, 'depth' : self.prepare_depth}
+        else:
+            # Depth is colorized by server.py with the viewer's depth range, so only small JPEGs are transferred
+            params = {'color' : {'max_width' : COLOR_PREVIEW_WIDTH},
+                      'depth' : {'max_width' : DEPTH_PREVIEW_WIDTH, 'depth_range' : list(depth_range)}}
+            self.watcher = RemoteFrameWatcher(addresses, DISCOVERY_INTERVAL_MS / 1000, params)
+            self.decoders = {'color' : lambda content: self.prepare_color(io.BytesIO(content)),
+                             'depth' : self.prepare_depth_preview}
+
+        # Measured frame rates and frame ages can be exported to CSV log
+        self.log = None
+        if log_path is not None:
+            self.log = open(log_path, 'w')
+            self.log.write('time,camera,stream,fps,age_ms\n')
+
+    def add_camera(self, serial, address=None):
+        frame = tk.Frame(self)
+        overlay = tk.Label(frame, font='TkFixedFont', anchor='w')
+        overlay.grid(row=0, column=0, columnspan=len(STREAMS), sticky='w')
+        labels = {}
+        for column, (stream, _) in enumerate(STREAMS):
+            labels[stream] = tk.Label(frame)
+            labels[stream].grid(row=1, column=column)
+        self.cameras[serial] = {'frame' : frame, 'overlay' : overlay, 'labels' : labels,
+                                'images' : {stream : None for stream, _ in STREAMS},
+                                'mtimes' : {stream : None for stream, _ in STREAMS}}
+
+        for stream, filename in STREAMS:
+            source = address if address is not None else os.path.join(self.path, serial, stream, filename)
+            self.watcher.watch((serial, stream), source, self.decoders[stream])
+
+    def remove_camera(self, serial):
+        for stream, _ in STREAMS:
+            self.watcher.unwatch((serial, stream))
+        self.cameras.pop(serial)['frame'].destroy()
+
+    def layout_cameras(self):
+        # Cell of a camera is about three times wider than high
+        columns = max(1, round(math.sqrt(len(self.cameras) / 3)))
+        for i, serial in enumerate(sorted(self.cameras.keys())):
+            self.cameras[serial]['frame'].grid(row=i // columns, column=i % columns, padx=2, pady=2)
+
+    def discover_cameras(self):
+        if isinstance(self.watcher, RemoteFrameWatcher):
+            addresses = self.watcher.cameras()
+        else:
+            try:
+                addresses = {entry.name : None for entry in os.scandir(self.path) if entry.is_dir()}
+            except FileNotFoundError: # recording hasn't started yet
+                addresses = {}
+        serials = set(addresses.keys())
+
+        if serials != set(self.cameras.keys()):
+            for serial in set(self.cameras.keys()) - serials:
+                self.remove_camera(serial)
+            for serial in serials - set(self.cameras.keys()):
+                self.add_camera(serial, addresses[serial])
+            self.layout_cameras()
+
+        self.after(DISCOVERY_INTERVAL_MS, self.discover_cameras)
 
-    def config_label(self, image, image_index, row_index):
-        self.images[image_index][row_index] = ImageTk.PhotoImage(image)
-        self.labels[image_index][row_index].config(image=self.images[image_index][row_index])
-        
-    def prepare_color(self, image, image_index):
+    def update_stats(self):
+        now = time.time_ns()
+        for serial in sorted(self.cameras.keys()):
+            camera = self.cameras[serial]
+            text = serial
+            for stream, _ in STREAMS:
+                fps = self.watcher.frame_rate((serial, stream))
+                mtime = camera['mtimes'][stream]
+                # Age of the displayed frame shows lagging cameras and the viewer's own delay
+                age_ms = (now - mtime) / 1e6 if mtime is not None else None
+                text += f'  {stream} ' + (f'{fps:4.1f} fps' if fps is not None else ' -- fps') + \
+                        (f' {age_ms:6.0f} ms' if age_ms is not None else '     -- ms')
+                if self.log is not None:
+                    self.log.write(f'{now / 1e9:.3f},{serial},{stream},{"" if fps is None else f"{fps:.2f}"},'
+                                   f'{"" if age_ms is None else f"{age_ms:.0f}"}\n')
+            camera['overlay'].config(text=text)
+        if self.log is not None:
+            self.log.flush()
+
+        self.after(STATS_INTERVAL_MS, self.update_stats)
+
+    def config_label(self, image, serial, stream):
+        camera = self.cameras[serial]
+        photo = camera['images'][stream]
+        # Existing PhotoImage is updated in place, a new one is created only when the size changes
+        if photo is not None and (photo.width(), photo.height()) == image.size:
+            photo.paste(image)
+            return
+        camera['images'][stream] = ImageTk.PhotoImage(image)
+        camera['labels'][stream].config(image=camera['images'][stream])
+
+    def prepare_color(self, image):
         image = Image.open(image)
-        image = image.resize((int(image.size[0]/2.5), int(image.size[1]/2.5)))
+        size = (COLOR_PREVIEW_WIDTH, round(COLOR_PREVIEW_WIDTH * image.size[1] / image.size[0]))
+        # JPEG decoder scales by 1/2, 1/4 or 1/8 in DCT domain to the smallest size not less than the preview,
+        # so decoding cost doesn't grow with color mode resolution
+        image.draft('RGB', size)
+        image = image.resize(size, Image.BILINEAR)
         if self.flip:
             image = image.transpose(Image.FLIP_LEFT_RIGHT)
-        self.config_label(image, image_index, 0)
-        
-    def prepare_depth(self, image, image_index):
-        array = np.fromfile(image, dtype=np.uint16)
-        array = self.rescale(array)            
-        image = Image.fromarray(array.reshape(576,640)[::2,::2])
+        return image
+
+    def prepare_depth(self, image):
+        return self.depth_preview(read_depth(image, self.depth_buffers))
+
+    def prepare_depth_preview(self, content):
+        image = Image.open(io.BytesIO(content)).convert('RGB')
         if self.flip:
             image = image.transpose(Image.FLIP_LEFT_RIGHT)
-        self.config_label(image, image_index, 1)
+        return image
+
+    def depth_preview(self, array):
+        # Decimation is a view, so only the shown pixels go through the colormap lookup
+        image = colorize_depth(array[::DEPTH_DECIMATION, ::DEPTH_DECIMATION], self.depth_lut)
+        if self.flip:
+            image = image.transpose(Image.FLIP_LEFT_RIGHT)
+        return image
 
     def display_next_slide(self):
-        try:
-            for i in range(3):
-                self.prepare_color(f'{image_path}/{ids[i]}/color/0.jpg', i)
-                self.prepare_depth(f'{image_path}/{ids[i]}/depth/0.bin', i)
-        except:
-            pass
+        for (serial, stream), (image, mtime) in self.watcher.pop_ready().items():
+            if serial in self.cameras:
+                self.config_label(image, serial, stream)
+                self.cameras[serial]['mtimes'][stream] = mtime
 
         self.after(self.duration_ms, self.display_next_slide)
- 
+
     def start(self):
+        self.watcher.start()
+        self.discover_cameras()
         self.display_next_slide()
+        self.update_stats()
 
 def main():
     argument_parser = argparse.ArgumentParser("Multiview streamer")
     argument_parser.add_argument("--flip", "-f", type=int, required=False, default=0)
+    argument_parser.add_argument("--depth_range", type=int, nargs=2, required=False, default=DEPTH_RANGE_DEFAULT,
+                                 help="Min and max depth in mm mapped onto the depth colormap")
+    argument_parser.add_argument("--image_path", type=str, required=False, default=image_path,
+                                 help="Path to directories of cameras with latest frames")
+    argument_parser.add_argument("--log", type=str, required=False,
+                                 help="Path to CSV file to log measured frame rate and age of displayed frame of every camera")
+    argument_parser.add_argument("--remote", action="store_true",
+                                 help="Pull frames from server.py of nodes instead of local tmpfs")
+    argument_parser.add_argument("--addresses", type=str, required=False, nargs="+",
+                                 help="Addresses of nodes for --remote, addresses of DEFAULT_PARAMS by default")
     args = argument_parser.parse_args()
     if args.flip == 0:
         flip = False
@@ -82,7 +406,11 @@ def main():
     else:
         raise RuntimeError("Only 0 and 1 values allowed for flip parameter")
 
-    application = Application(flip)
+    addresses = None
+    if args.remote:
+        addresses = args.addresses if args.addresses is not None else [cam['address'] for cam in DEFAULT_PARAMS.values()]
+
+    application = Application(flip, args.depth_range, args.image_path, args.log, addresses)
     application.start()
     application.mainloop()
 
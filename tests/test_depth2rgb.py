@@ -0,0 +1,95 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark_depth2rgb import COLOR_MODES, DEPTH_MODES, create_aligner, synthetic_frames, write_synthetic_calib_params
+from depth2rgb import VISIBILITY_TOLERANCE
+
+# Share of single-hit pixels allowed to differ, float32 and float64 round differently at pixel borders
+MAX_MISMATCH_SHARE = 1e-3
+
+
+def create_synthetic_aligner(path, depth_mode='NFOV_UNBINNED', color_mode='720p'):
+    write_synthetic_calib_params(path, DEPTH_MODES[depth_mode], COLOR_MODES[color_mode])
+    return create_aligner(str(path), str(path))
+
+def reference_projection(aligner, img_depth):
+    """
+    Previous float64 projection with last-write-wins scatter, restricted to measured points.
+    Returns depth image, number of points landing to every pixel and depth image of the nearest points.
+    """
+    h, w = aligner.shape_c
+    grid_x, grid_y = np.meshgrid(np.arange(aligner.shape_d[1]), np.arange(aligner.shape_d[0]))
+    rays = aligner.to_norm_image_coord(np.stack([grid_x, grid_y], axis=-1).reshape(-1, 2), aligner.Kd_undistorted)
+    depth = img_depth.reshape(-1)
+    measured = depth > 0
+
+    P = aligner.depth2color_projection
+    proj_pcd = (rays * depth[:, None].astype(np.float64))[measured] @ P[:, :3].T + P[:, 3]
+    z = proj_pcd[:, 2]
+    proj_pcd = np.round(proj_pcd[:, :2] / z[:, None]).astype(int)
+    proj_mask = (proj_pcd[:, 0] >= 0) & (proj_pcd[:, 0] < w) & (proj_pcd[:, 1] >= 0) & (proj_pcd[:, 1] < h)
+    proj_pcd, z = proj_pcd[proj_mask], z[proj_mask]
+
+    pcd_image = np.zeros((h, w))
+    pcd_image[proj_pcd[:, 1], proj_pcd[:, 0]] = z
+    pixel_index = proj_pcd[:, 1] * w + proj_pcd[:, 0]
+    hits = np.bincount(pixel_index, minlength=h * w).reshape(h, w)
+    nearest = np.full(h * w, np.inf)
+    np.minimum.at(nearest, pixel_index, z)
+    nearest[np.isinf(nearest)] = 0
+    return pcd_image.astype(np.uint16), hits, nearest.reshape(h, w).astype(np.uint16)
+
+def test_project_depth_matches_float64_on_single_hit_pixels(tmp_path):
+    aligner = create_synthetic_aligner(tmp_path)
+    for seed in range(3):
+        img_depth, _ = synthetic_frames(aligner.shape_d, aligner.shape_c, seed)
+        expected, hits, _ = reference_projection(aligner, img_depth)
+        projected = aligner.project_depth(img_depth)
+
+        single = hits == 1
+        difference = np.abs(projected[single].astype(np.int32) - expected[single].astype(np.int32))
+        # Depth of a point may be truncated to the neighbouring mm in float32
+        mismatches = np.count_nonzero(difference > 1)
+        assert single.sum() > 0.1 * single.size
+        assert mismatches <= MAX_MISMATCH_SHARE * single.sum()
+
+def test_project_depth_keeps_nearest_point(tmp_path):
+    # Wide depth field of view is denser than color pixels, so many points land to the same pixel
+    aligner = create_synthetic_aligner(tmp_path, depth_mode='WFOV_UNBINNED')
+    img_depth, _ = synthetic_frames(aligner.shape_d, aligner.shape_c)
+    # Near object in front of the plane hides a part of it from the color camera
+    img_depth[200:300, 250:350] = 500
+    last, hits, nearest = reference_projection(aligner, img_depth)
+    projected = aligner.project_depth(img_depth)
+
+    multiple = hits > 1
+    difference = np.abs(projected[multiple].astype(np.int32) - nearest[multiple].astype(np.int32))
+    assert np.count_nonzero(last[multiple] != nearest[multiple]) > 0.1 * multiple.sum()
+    assert np.count_nonzero(difference > 1) <= MAX_MISMATCH_SHARE * multiple.sum()
+
+def test_project_depth_ignores_missing_depth(tmp_path):
+    aligner = create_synthetic_aligner(tmp_path)
+    img_depth = np.zeros(aligner.shape_d, dtype=np.uint16)
+    assert not aligner.project_depth(img_depth).any()
+
+def test_point_cloud_keeps_visible_points_only(tmp_path):
+    aligner = create_synthetic_aligner(tmp_path, depth_mode='WFOV_UNBINNED')
+    img_depth, img_rgb = synthetic_frames(aligner.shape_d, aligner.shape_c)
+    img_depth[200:300, 250:350] = 500
+    projected = aligner.project_depth(img_depth).astype(np.float64)
+    points, colors = aligner.point_cloud_of_last_projection(img_rgb)
+
+    # Pixels of exported points in color image
+    pixels = points @ aligner.Kc_undistorted.T
+    u = np.rint(pixels[:, 0] / pixels[:, 2]).astype(int)
+    v = np.rint(pixels[:, 1] / pixels[:, 2]).astype(int)
+    inside = (u >= 0) & (u < aligner.shape_c[1]) & (v >= 0) & (v < aligner.shape_c[0])
+    nearest = projected[v[inside], u[inside]]
+    occluded = points[inside, 2] > nearest * (1 + VISIBILITY_TOLERANCE) + 1
+    assert len(points) < np.count_nonzero(aligner.valid_buffer)
+    assert np.count_nonzero(occluded) <= MAX_MISMATCH_SHARE * len(points)
+    assert len(colors) == len(points)
@@ -0,0 +1,49 @@
+import os
+import platform
+import subprocess
+import time
+
+import numpy as np
+
+# Image shapes [h, w] of Azure Kinect depth and color modes
+DEPTH_MODES = {'NFOV_2X2BINNED' : (288, 320),
+               'NFOV_UNBINNED'  : (576, 640),
+               'WFOV_2X2BINNED' : (512, 512),
+               'WFOV_UNBINNED'  : (1024, 1024)}
+PASSIVE_IR_SHAPE = (1024, 1024)
+COLOR_MODES = {'720p'  : (720, 1280),
+               '1080p' : (1080, 1920),
+               '1440p' : (1440, 2560),
+               '1536p' : (1536, 2048),
+               '2160p' : (2160, 3840),
+               '3072p' : (3072, 4096)}
+
+repository_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def time_it(function, repeats):
+    """
+    Run function several times and return timing statistics in seconds.
+    """
+    function() # warm up
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return {'repeats' : repeats, 'min_s' : min(times), 'mean_s' : float(np.mean(times)), 'median_s' : float(np.median(times))}
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=repository_path, stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+def report_environment():
+    """
+    Returns dict of commit, date and machine of a benchmark run for its JSON report.
+    """
+    return {'commit' : git_commit(),
+            'date' : time.strftime('%Y-%m-%d-%H-%M-%S'),
+            'platform' : platform.platform(),
+            'processor' : platform.processor(),
+            'cpu_count' : os.cpu_count()}
@@ -0,0 +1,194 @@
+import json
+import os
+import threading
+import warnings
+
+import cv2
+import numpy as np
+
+# Layout of a chunked frames folder:
+#   chunks.json          - shapes of frames, color encoding and number of frames per chunk
+#   index.csv            - one line per frame: timestamp, chunk, depth_offset, color_offset, color_size
+#   depth_{chunk}.bin    - raw uint16 depth frames one after another, can be memory-mapped
+#   color_{chunk}.bin    - encoded color frames ('jpg', 'png', ...) or raw uint8 frames ('raw')
+META_FILENAME = 'chunks.json'
+INDEX_FILENAME = 'index.csv'
+INDEX_HEADER = 'timestamp,chunk,depth_offset,color_offset,color_size\n'
+
+def chunk_filename(kind, chunk):
+    return f'{kind}_{chunk:06}.bin'
+
+
+class FrameChunkWriter:
+    """
+    Appends depth and color frames to large chunk files instead of writing a pair of files per frame.
+    Frames are encoded by encode() which is safe to call from several threads,
+    and then appended in the wanted order by append().
+    """
+
+    def __init__(self, path, depth_shape, color_shape, color_encoding='jpg', jpeg_quality=95, frames_per_chunk=256):
+        """
+        :param path: output folder
+        :param depth_shape: shape of depth frames [h, w]
+        :param color_shape: shape of color frames [h, w, 3]
+        :param color_encoding: 'raw' or image format for cv2.imencode, e.g. 'jpg'
+        :param jpeg_quality: quality of 'jpg' color encoding
+        :param frames_per_chunk: number of frames in one chunk file
+        """
+        self.path = path
+        self.depth_shape = tuple(depth_shape)
+        self.color_shape = tuple(color_shape)
+        self.color_encoding = color_encoding
+        self.frames_per_chunk = frames_per_chunk
+        self.encode_params = [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality] if color_encoding == 'jpg' else []
+
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, META_FILENAME), 'w') as f:
+            json.dump({'depth_shape' : self.depth_shape,
+                       'color_shape' : self.color_shape,
+                       'color_encoding' : color_encoding,
+                       'frames_per_chunk' : frames_per_chunk}, f)
+
+        self.index = open(os.path.join(path, INDEX_FILENAME), 'w')
+        self.index.write(INDEX_HEADER)
+        self.lock = threading.Lock()
+        self.frames = 0
+        self.chunk = None
+        self.depth_file = None
+        self.color_file = None
+
+    def encode(self, timestamp, depth, color):
+        """
+        Returns frame prepared for append().
+        :param timestamp: timestamp of the frame, int or string of digits
+        :param depth: depth image, np.ndarray([h, w]) of uint16
+        :param color: color image, np.ndarray([h, w, 3]) of uint8
+        """
+        if depth.shape != self.depth_shape or color.shape != self.color_shape:
+            raise ValueError(f'Frame shapes {depth.shape}, {color.shape} differ from {self.depth_shape}, {self.color_shape}')
+        depth_bytes = np.ascontiguousarray(depth, dtype=np.uint16).tobytes()
+        if self.color_encoding == 'raw':
+            color_bytes = np.ascontiguousarray(color, dtype=np.uint8).tobytes()
+        else:
+            success, encoded = cv2.imencode('.' + self.color_encoding, color, self.encode_params)
+            if not success:
+                raise RuntimeError(f'Color frame {timestamp} is not encoded to {self.color_encoding}')
+            color_bytes = encoded.tobytes()
+        return int(timestamp), depth_bytes, color_bytes
+
+    def append(self, frame):
+        """
+        Append frame returned by encode() to the current chunk.
+        :param frame: (timestamp, depth_bytes, color_bytes)
+        """
+        timestamp, depth_bytes, color_bytes = frame
+        with self.lock:
+            chunk = self.frames // self.frames_per_chunk
+            if chunk != self.chunk:
+                self.close_chunk()
+                self.chunk = chunk
+                self.depth_file = open(os.path.join(self.path, chunk_filename('depth', chunk)), 'wb')
+                self.color_file = open(os.path.join(self.path, chunk_filename('color', chunk)), 'wb')
+
+            depth_offset = self.depth_file.tell()
+            color_offset = self.color_file.tell()
+            self.depth_file.write(depth_bytes)
+            self.color_file.write(color_bytes)
+            self.index.write(f'{timestamp},{chunk},{depth_offset},{color_offset},{len(color_bytes)}\n')
+            self.frames += 1
+
+    def write(self, timestamp, depth, color):
+        self.append(self.encode(timestamp, depth, color))
+
+    def close_chunk(self):
+        for f in (self.depth_file, self.color_file):
+            if f is not None:
+                f.close()
+        self.depth_file = None
+        self.color_file = None
+        # Index lines are flushed with every finished chunk, so frames of closed chunks survive a crash
+        self.index.flush()
+
+    def close(self):
+        with self.lock:
+            self.close_chunk()
+            self.index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class FrameChunkReader:
+    """
+    Random access to frames written by FrameChunkWriter.
+    Chunk files are memory-mapped, so reading frame k doesn't touch the filesystem per frame.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: folder with chunks
+        """
+        self.path = path
+        with open(os.path.join(path, META_FILENAME)) as f:
+            meta = json.load(f)
+        self.depth_shape = tuple(meta['depth_shape'])
+        self.color_shape = tuple(meta['color_shape'])
+        self.color_encoding = meta['color_encoding']
+
+        with warnings.catch_warnings(): # index of a container without frames has the header only
+            warnings.simplefilter('ignore', UserWarning)
+            index = np.loadtxt(os.path.join(path, INDEX_FILENAME), delimiter=',', skiprows=1, dtype=np.int64, ndmin=2)
+        if len(index) == 0:
+            index = np.empty((0, 5), np.int64)
+        index = index[np.argsort(index[:, 0], kind='stable')]
+        self.timestamps = index[:, 0]
+        self.chunks = index[:, 1]
+        self.depth_offsets = index[:, 2]
+        self.color_offsets = index[:, 3]
+        self.color_sizes = index[:, 4]
+        self.maps = {}
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def map(self, kind, chunk):
+        if (kind, chunk) not in self.maps:
+            self.maps[(kind, chunk)] = np.memmap(os.path.join(self.path, chunk_filename(kind, chunk)), dtype=np.uint8, mode='r')
+        return self.maps[(kind, chunk)]
+
+    def find(self, timestamp):
+        """
+        Returns index of the frame with the timestamp.
+        :param timestamp: timestamp of the frame, int or string of digits
+        """
+        k = np.searchsorted(self.timestamps, int(timestamp))
+        if k == len(self.timestamps) or self.timestamps[k] != int(timestamp):
+            raise KeyError(f'No frame with timestamp {timestamp}')
+        return int(k)
+
+    def depth(self, k):
+        """
+        Returns depth frame k, np.ndarray([h, w]) of uint16. The array is a read-only view of the chunk file.
+        """
+        size = self.depth_shape[0] * self.depth_shape[1] * 2
+        offset = self.depth_offsets[k]
+        return self.map('depth', self.chunks[k])[offset:offset + size].view(np.uint16).reshape(self.depth_shape)
+
+    def color(self, k):
+        """
+        Returns color frame k, np.ndarray([h, w, 3]) of uint8.
+        """
+        offset = self.color_offsets[k]
+        data = self.map('color', self.chunks[k])[offset:offset + self.color_sizes[k]]
+        if self.color_encoding == 'raw':
+            return data.reshape(self.color_shape)
+        return cv2.imdecode(np.asarray(data), cv2.IMREAD_COLOR)
+
+    def __getitem__(self, k):
+        """
+        Returns (timestamp, depth, color) of frame k.
+        """
+        return self.timestamps[k], self.depth(k), self.color(k)
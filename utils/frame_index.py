@@ -0,0 +1,128 @@
+import os
+import threading
+import time
+
+IDLE_TIMEOUT = 5 # seconds without requests after which the folder is not scanned
+
+class LatestFrameIndex(threading.Thread):
+    """
+    Keeps the latest frame file of every camera stream in a tmpfs images folder of mrob_recorder
+    ({path}/{camera}/{kind}/*), so a request for the latest frame doesn't list and stat the whole folder.
+    The folder is watched by polling: a stream directory is listed again only when its mtime changes,
+    otherwise only the known latest file is checked for being rewritten in place.
+    Every new latest frame gets the next sequence number of its stream.
+    Polling stops when nobody asks for frames for idle_timeout, the first request after that scans the folder itself.
+    """
+
+    def __init__(self, path, interval, idle_timeout=IDLE_TIMEOUT):
+        """
+        :param path: images folder with directories of cameras
+        :param interval: polling interval, s
+        :param idle_timeout: polling stops after this time without requests, s
+        """
+        threading.Thread.__init__(self, daemon=True)
+        self.path = path
+        self.interval = interval
+        self.idle_timeout = idle_timeout
+        self.directories = {} # (camera, kind): mtime of stream directory when it was listed
+        self.latest = {} # (camera, kind): (path, ctime, size, sequence number)
+        self.lock = threading.Lock()
+        self.scan_lock = threading.Lock()
+        self.last_request = None
+        self.requested = threading.Event() # set when a request comes after idle time
+
+    def idle(self):
+        return self.last_request is None or time.monotonic() - self.last_request > self.idle_timeout
+
+    def touch(self):
+        """
+        Mark a request for frames. After idle time the folder is scanned at once, so the request gets fresh frames.
+        """
+        idle = self.idle()
+        self.last_request = time.monotonic()
+        if idle:
+            self.scan()
+            self.requested.set()
+
+    def cameras(self):
+        self.touch()
+        with self.lock:
+            return sorted({camera for camera, _ in self.latest.keys()})
+
+    def get(self, camera, kind):
+        """
+        Returns (path, ctime, size, sequence number) of the latest frame, None if there are no frames.
+        :param camera: serial number of camera, the first camera with frames if None
+        :param kind: 'color' or 'depth'
+        """
+        self.touch()
+        with self.lock:
+            if camera is None:
+                cameras = sorted(camera for camera, stream in self.latest.keys() if stream == kind)
+                if len(cameras) == 0:
+                    return None
+                camera = cameras[0]
+            return self.latest.get((camera, kind))
+
+    def update(self, key, latest):
+        with self.lock:
+            previous = self.latest.get(key)
+            if latest is None:
+                self.latest.pop(key, None)
+            elif previous is None or previous[:3] != latest:
+                self.latest[key] = (*latest, previous[3] + 1 if previous is not None else 0)
+
+    def scan_directory(self, key, directory):
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+            if self.directories.get(key) != mtime:
+                # Files were added, removed or renamed
+                self.directories[key] = mtime
+                latest = None
+                for entry in os.scandir(directory):
+                    stat = entry.stat()
+                    if latest is None or stat.st_ctime_ns > latest[1]:
+                        latest = (entry.path, stat.st_ctime_ns, stat.st_size)
+            else:
+                with self.lock:
+                    latest = self.latest.get(key)
+                if latest is not None:
+                    stat = os.stat(latest[0])
+                    latest = (latest[0], stat.st_ctime_ns, stat.st_size)
+        except FileNotFoundError: # folder is cleaned up before recording
+            self.directories.pop(key, None)
+            latest = None
+        self.update(key, latest)
+
+    def scan(self):
+        with self.scan_lock: # polling thread and a request after idle time may scan at once
+            self.scan_folder()
+
+    def scan_folder(self):
+        keys = set()
+        try:
+            cameras = [camera for camera in os.scandir(self.path) if camera.is_dir()]
+        except FileNotFoundError:
+            cameras = []
+        for camera in cameras:
+            try:
+                kinds = [kind for kind in os.scandir(camera.path) if kind.is_dir()]
+            except FileNotFoundError:
+                continue
+            for kind in kinds:
+                keys.add((camera.name, kind.name))
+                self.scan_directory((camera.name, kind.name), kind.path)
+        with self.lock:
+            for key in set(self.latest.keys()) - keys:
+                self.latest.pop(key)
+        for key in set(self.directories.keys()) - keys:
+            self.directories.pop(key)
+
+    def run(self):
+        while True:
+            # Cleared before the check, so a request coming meanwhile isn't missed
+            self.requested.clear()
+            if self.idle():
+                self.requested.wait()
+            self.scan()
+            time.sleep(self.interval)
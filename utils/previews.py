@@ -0,0 +1,120 @@
+import io
+import math
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+import numpy as np
+from PIL import Image
+
+DEPTH_RANGE_DEFAULT = (250, 4000) # mm, depths out of range get the end colors of colormap
+# Shapes of depth frames of Azure Kinect depth modes by their size in bytes
+DEPTH_SHAPES = {h * w * 2 : (h, w) for h, w in [(288, 320), (576, 640), (512, 512), (1024, 1024)]}
+# Anchor colors of jet colormap from near to far
+COLORMAP_ANCHORS = np.array([[0, 0, 128], [0, 0, 255], [0, 255, 255], [255, 255, 0], [255, 0, 0], [128, 0, 0]])
+
+def depth_colormap_lut(depth_range):
+    """
+    Returns color of every possible uint16 depth packed to RGBX bytes of uint32, np.ndarray(65536) of uint32.
+    One uint32 per pixel makes lookup a single np.take, which is much faster than gathering RGB triplets.
+    Zero depth (no measurement) is black.
+    :param depth_range: (min, max) depth mapped onto the whole colormap
+    """
+    depths = np.arange(65536)
+    position = np.clip((depths - depth_range[0]) / (depth_range[1] - depth_range[0]), 0, 1) * (len(COLORMAP_ANCHORS) - 1)
+    anchors = np.arange(len(COLORMAP_ANCHORS))
+    lut = np.stack([np.interp(position, anchors, COLORMAP_ANCHORS[:, channel]) for channel in range(3)], axis=-1)
+    lut = np.concatenate([np.rint(lut).astype(np.uint8), np.zeros((65536, 1), dtype=np.uint8)], axis=-1)
+    lut[0] = 0
+    return lut.view(np.uint32).reshape(-1)
+
+def colorize_depth(array, lut):
+    """
+    Returns RGB image of depth colored by LUT of depth_colormap_lut.
+    :param array: depth frame np.ndarray([h, w]) of uint16
+    """
+    colors = np.take(lut, array)
+    return Image.frombytes('RGB', colors.shape[::-1], colors, 'raw', 'RGBX')
+
+def depth_from_bytes(data):
+    """
+    Returns depth frame np.ndarray([h, w]) of uint16 from raw bytes of mrob_recorder depth file.
+    """
+    if len(data) not in DEPTH_SHAPES:
+        raise ValueError(f'Size {len(data)} doesn\'t match any depth mode')
+    return np.frombuffer(data, dtype=np.uint16).reshape(DEPTH_SHAPES[len(data)])
+
+@lru_cache(maxsize=4)
+def cached_depth_colormap_lut(depth_range):
+    return depth_colormap_lut(depth_range)
+
+def encode_preview(data, kind, max_width=None, quality=75, grayscale=False, depth_range=DEPTH_RANGE_DEFAULT):
+    """
+    Returns JPEG bytes of a downscaled preview of a frame.
+    :param data: bytes of color JPEG or raw uint16 depth frame
+    :param kind: 'color' or 'depth', depth is colorized
+    :param max_width: width of preview, frames narrower than it are not upscaled
+    :param quality: JPEG quality
+    :param grayscale: encode single channel preview
+    :param depth_range: (min, max) depth mapped onto the whole colormap
+    """
+    if kind == 'color':
+        image = Image.open(io.BytesIO(data))
+        if max_width is not None and image.size[0] > max_width:
+            size = (max_width, round(max_width * image.size[1] / image.size[0]))
+            # JPEG decoder scales in DCT domain, so big color modes aren't decoded in full resolution
+            image.draft('L' if grayscale else 'RGB', size)
+            image = image.resize(size, Image.BILINEAR)
+    else:
+        array = depth_from_bytes(data)
+        # Depth is decimated before colorizing, every n-th pixel is enough for a preview
+        step = math.ceil(array.shape[1] / max_width) if max_width is not None else 1
+        image = colorize_depth(array[::step, ::step], cached_depth_colormap_lut(tuple(depth_range)))
+    image = image.convert('L' if grayscale else 'RGB')
+    output = io.BytesIO()
+    image.save(output, format='JPEG', quality=quality)
+    return output.getvalue()
+
+
+class PreviewCache:
+    """
+    Small LRU cache of encoded previews, so viewers asking for the same variant of a frame share one encode.
+    Concurrent requests for a missing preview wait for the first one to encode it.
+    """
+
+    def __init__(self, size):
+        """
+        :param size: number of kept previews
+        """
+        self.size = size
+        self.previews = OrderedDict()
+        self.pending = {} # key: threading.Event set when the preview is encoded
+        self.lock = threading.Lock()
+
+    def get(self, key, encode):
+        """
+        Returns cached preview or encodes it by encode().
+        :param key: (camera, frame, variant), frame must change with every new frame
+        :param encode: function without arguments returning the preview
+        """
+        while True:
+            with self.lock:
+                if key in self.previews:
+                    self.previews.move_to_end(key)
+                    return self.previews[key]
+                pending = self.pending.get(key)
+                if pending is None:
+                    self.pending[key] = threading.Event()
+                    break
+            pending.wait()
+
+        try:
+            preview = encode()
+            with self.lock:
+                self.previews[key] = preview
+                while len(self.previews) > self.size:
+                    self.previews.popitem(last=False)
+        finally:
+            with self.lock:
+                self.pending.pop(key).set()
+        return preview
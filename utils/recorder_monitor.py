@@ -0,0 +1,138 @@
+import os
+import re
+import shutil
+import sys
+import threading
+import time
+from collections import deque
+
+# Recorder output lines are counted by the first matching pattern (case insensitive).
+# Warnings of Azure Kinect SDK about dropped captures and lost sync are printed to stderr,
+# timestamps of captures are printed by mrob_recorder
+OUTPUT_PATTERNS = [('drops', re.compile(r'drop', re.IGNORECASE)),
+                   ('sync_warnings', re.compile(r'sync.*(warn|lost|fail|timeout)|(warn|lost|fail|timeout).*sync', re.IGNORECASE)),
+                   ('errors', re.compile(r'\berror\b|\bfail', re.IGNORECASE)),
+                   ('captures', re.compile(r'timestamp', re.IGNORECASE))]
+# Subordinate recorder prints it when its device is started and waits for sync pulses of master
+READY_MARKER = 'Waiting for signal from master'
+OUTPUT_LINES = 200 # lines kept in the ring buffer
+RATE_INTERVAL = 0.5 # seconds, minimal interval between MKV size samples of write rate
+
+
+class RecorderMonitor:
+    """
+    Health of one mrob_recorder process: the last lines of its output, counters of parsed output lines
+    and write rate of its MKV file computed from successive file sizes.
+    """
+
+    def __init__(self, output_lines=OUTPUT_LINES):
+        """
+        :param output_lines: number of the last output lines kept
+        """
+        self.output = deque(maxlen=output_lines)
+        self.counters = {name : 0 for name, _ in OUTPUT_PATTERNS}
+        self.counters['output_lines'] = 0
+        self.last_output_time = None
+        self.size = None
+        self.size_sample = None # (size, time) of the last write rate update
+        self.write_rate = None # bytes/s
+        self.last_growth_time = time.monotonic() # MKV is expected to grow since the recorder start
+        self.armed = threading.Event()
+        self.lock = threading.Lock()
+
+    def feed(self, line):
+        """
+        Add a line of recorder output.
+        """
+        line = line.rstrip()
+        if READY_MARKER in line:
+            self.armed.set()
+        with self.lock:
+            self.output.append(line)
+            self.counters['output_lines'] += 1
+            self.last_output_time = time.time()
+            for name, pattern in OUTPUT_PATTERNS:
+                if pattern.search(line):
+                    self.counters[name] += 1
+                    break
+
+    def update_size(self, size):
+        """
+        Add a sample of MKV file size, write rate is updated if the previous sample is older than RATE_INTERVAL.
+        """
+        now = time.monotonic()
+        with self.lock:
+            if self.size is None or size > self.size:
+                self.last_growth_time = now
+            self.size = size
+            if self.size_sample is None:
+                self.size_sample = (size, now)
+            elif now - self.size_sample[1] >= RATE_INTERVAL:
+                self.write_rate = (size - self.size_sample[0]) / (now - self.size_sample[1])
+                self.size_sample = (size, now)
+
+    def ready(self):
+        return self.armed.is_set()
+
+    def wait_ready(self, timeout):
+        """
+        Wait till recorder reports it is armed, returns False on timeout.
+        """
+        return self.armed.wait(timeout)
+
+    def lines(self, n=None):
+        with self.lock:
+            lines = list(self.output)
+        return lines if n is None else lines[-n:]
+
+    def metrics(self):
+        """
+        Returns dict of raw numbers: counters, write rate in bytes/s and seconds since the last output line.
+        """
+        with self.lock:
+            metrics = dict(self.counters)
+            metrics['mkv_file_size'] = self.size
+            metrics['mkv_write_rate'] = self.write_rate
+            metrics['seconds_since_growth'] = time.monotonic() - self.last_growth_time
+            metrics['ready'] = self.ready()
+            metrics['seconds_since_output'] = time.time() - self.last_output_time if self.last_output_time is not None else None
+        return metrics
+
+
+def recording_metrics(returncode, monitor, mkv_path):
+    """
+    Returns dict of raw numbers describing one recording, the same for local recorders and server.py of nodes.
+    :param returncode: return code of the recorder process, None while it is running
+    :param mkv_path: path to MKV file of the recording
+    """
+    try:
+        monitor.update_size(os.path.getsize(mkv_path))
+    except FileNotFoundError: # recorder hasn't created the file yet
+        pass
+    return {'recording_is_running' : returncode is None,
+            'returncode' : returncode,
+            'disk_free' : shutil.disk_usage(os.path.dirname(os.path.abspath(mkv_path))).free,
+            **monitor.metrics()}
+
+def line_buffered(args):
+    """
+    Returns command line running args with line buffered output if stdbuf is available,
+    so output of a recorder reaches its monitor when it is printed, not when the pipe buffer fills.
+    """
+    return (['stdbuf', '-oL', '-eL'] if shutil.which('stdbuf') is not None else []) + list(args)
+
+def follow_output(stream, monitor, echo=None):
+    """
+    Start a thread feeding lines of binary stream of a local process to monitor.
+    :param echo: threading.Event, lines are printed to stdout as they come while it is set
+    """
+    def follow():
+        for line in iter(stream.readline, b''):
+            line = line.decode('utf-8', errors='replace')
+            monitor.feed(line)
+            if echo is not None and echo.is_set():
+                sys.stdout.write(line)
+                sys.stdout.flush()
+    thread = threading.Thread(target=follow, daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,175 @@
+import csv
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Layout of manifest.json of a recording session:
+#   created    - time of writing
+#   params     - camera params or command lines of the recordings
+#   files      - by filename: size, block_size, sha256 of concatenated block digests, block_sha256,
+#                and for MKV files frames and duration_s from their timestamps tables
+MANIFEST_FILENAME = 'manifest.json'
+BLOCK_SIZE = 8 * 1024 ** 2 # bytes
+# Growing MKV is hashed only this far behind its end, since the writer may still patch recent clusters.
+# The first blocks are hashed again at stop, since the writer updates MKV header when finalizing
+SETTLE_MARGIN = 64 * 1024 ** 2 # bytes
+HEAD_BLOCKS = 1
+HASH_INTERVAL = 0.5 # seconds between hashing of new blocks of a growing file
+
+
+class StreamingHasher:
+    """
+    Hashes a file block by block while it grows, so at stop only the head and the tail are read again.
+    Block digests let a copy be verified block by block in parallel and show where it differs.
+    """
+
+    def __init__(self, path, block_size=BLOCK_SIZE):
+        """
+        :param path: path to the growing file
+        :param block_size: size of hashed blocks in bytes
+        """
+        self.path = path
+        self.block_size = block_size
+        self.block_digests = []
+        self.size = None
+        self.lock = threading.Lock()
+
+    def hash_block(self, f, index):
+        f.seek(index * self.block_size)
+        return hashlib.sha256(f.read(self.block_size)).digest()
+
+    def update(self, final=False):
+        """
+        Hash blocks which are not expected to change anymore.
+        :param final: file is closed by its writer, hash the rest and the head again
+        """
+        with self.lock:
+            try:
+                size = os.path.getsize(self.path)
+            except FileNotFoundError: # writer hasn't created the file yet
+                return
+            if size < len(self.block_digests) * self.block_size: # file is rewritten
+                self.block_digests = []
+            with open(self.path, 'rb') as f:
+                if final:
+                    for index in range(min(HEAD_BLOCKS, len(self.block_digests))):
+                        self.block_digests[index] = self.hash_block(f, index)
+                    while len(self.block_digests) * self.block_size < size:
+                        self.block_digests.append(self.hash_block(f, len(self.block_digests)))
+                    self.size = size
+                else:
+                    while (len(self.block_digests) + 1) * self.block_size <= size - SETTLE_MARGIN:
+                        self.block_digests.append(self.hash_block(f, len(self.block_digests)))
+
+    def summary(self):
+        """
+        Returns manifest entry of the file, update(final=True) must be called before.
+        """
+        with self.lock:
+            return {'size' : self.size,
+                    'block_size' : self.block_size,
+                    'sha256' : hashlib.sha256(b''.join(self.block_digests)).hexdigest(),
+                    'block_sha256' : [digest.hex() for digest in self.block_digests]}
+
+
+def timestamps_table_stats(path):
+    """
+    Returns number of frames and duration in seconds of a timestamps table of mrob_recorder.
+    Duration is taken from the first column with 'timestamp' in its name, or the first column, in microseconds.
+    """
+    with open(path, newline='') as f:
+        rows = [row for row in csv.reader(f) if len(row) > 0]
+    if len(rows) == 0:
+        return {'frames' : 0, 'duration_s' : None}
+    header = None
+    try:
+        int(rows[0][0])
+    except ValueError:
+        header, rows = rows[0], rows[1:]
+    column = 0
+    if header is not None:
+        column = next((i for i, name in enumerate(header) if 'timestamp' in name.lower()), 0)
+    try:
+        duration_s = (int(rows[-1][column]) - int(rows[0][column])) / 1e6 if len(rows) > 0 else None
+    except (ValueError, IndexError):
+        duration_s = None
+    return {'frames' : len(rows), 'duration_s' : duration_s}
+
+def write_manifest(folder, hashers, params):
+    """
+    Finish hashing of files and write manifest.json of a recording session, returns the manifest.
+    :param folder: session folder with the files
+    :param hashers: StreamingHasher of every MKV by filename, CSV tables are hashed at once
+    :param params: camera params or command lines of the recordings
+    """
+    files = {}
+    for filename, hasher in sorted(hashers.items()):
+        hasher.update(final=True)
+        if hasher.size is None: # recorder failed before creating the file
+            continue
+        files[filename] = hasher.summary()
+        table_filename = os.path.splitext(filename)[0] + '.csv'
+        table_path = os.path.join(folder, table_filename)
+        if os.path.exists(table_path):
+            files[filename].update(timestamps_table_stats(table_path))
+            table_hasher = StreamingHasher(table_path)
+            table_hasher.update(final=True)
+            files[table_filename] = table_hasher.summary()
+    manifest = {'created' : time.strftime('%Y-%m-%d-%H-%M-%S'), 'params' : params, 'files' : files}
+    with open(os.path.join(folder, MANIFEST_FILENAME), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+def follow_file(hasher, done, interval=HASH_INTERVAL):
+    """
+    Start a thread hashing new blocks of a growing local file till done is set.
+    Blocks are read shortly after they are written, while they are still in page cache.
+    :param done: threading.Event set when the writer is stopped
+    """
+    def follow():
+        while not done.wait(interval):
+            hasher.update()
+    thread = threading.Thread(target=follow, daemon=True)
+    thread.start()
+    return thread
+
+def verify_file(path, entry, workers):
+    """
+    Returns indexes of blocks of the file differing from its manifest entry, [-1] if size differs.
+    """
+    if not os.path.exists(path) or os.path.getsize(path) != entry['size']:
+        return [-1]
+    block_size = entry['block_size']
+    def block_differs(index):
+        # Every worker reads its block by pread, hashing of big blocks releases GIL
+        with open(path, 'rb') as f:
+            data = os.pread(f.fileno(), block_size, index * block_size)
+        return hashlib.sha256(data).hexdigest() != entry['block_sha256'][index]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        differs = list(executor.map(block_differs, range(len(entry['block_sha256']))))
+    return [index for index, differ in enumerate(differs) if differ]
+
+def verify_session(folder, quick=False, workers=None):
+    """
+    Returns dict of problems by filename for files of a session differing from its manifest.json, empty if the copy is intact.
+    :param quick: compare sizes only
+    :param workers: number of threads hashing blocks, number of CPUs by default
+    """
+    with open(os.path.join(folder, MANIFEST_FILENAME)) as f:
+        manifest = json.load(f)
+    workers = workers if workers is not None else os.cpu_count()
+    problems = {}
+    for filename, entry in manifest['files'].items():
+        path = os.path.join(folder, filename)
+        if not os.path.exists(path):
+            problems[filename] = 'missing'
+        elif os.path.getsize(path) != entry['size']:
+            problems[filename] = f'size {os.path.getsize(path)} instead of {entry["size"]}'
+        elif not quick:
+            blocks = verify_file(path, entry, workers)
+            if len(blocks) > 0:
+                problems[filename] = f'blocks {blocks} differ'
+    return problems
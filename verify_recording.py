@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+import argparse
+import sys
+import time
+
+from utils.session_manifest import MANIFEST_FILENAME, verify_session
+
+def main():
+    parser = argparse.ArgumentParser(description=f'Verify copied recordings of a session by its {MANIFEST_FILENAME} written when recording is stopped')
+    parser.add_argument('path',
+                        type=str,
+                        help='Session folder, e.g. records/2022-02-10-08-36-51')
+    parser.add_argument('--quick',
+                        action='store_true',
+                        help='Compare file sizes only')
+    parser.add_argument('--workers',
+                        type=int,
+                        required=False,
+                        help='Number of threads hashing blocks of files, number of CPUs by default')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    problems = verify_session(args.path, args.quick, args.workers)
+    for filename, problem in sorted(problems.items()):
+        print(f'{filename}: {problem}')
+    print(f'{"Intact" if len(problems) == 0 else "Damaged"}, verified in {time.perf_counter() - start:.2f} s')
+    sys.exit(0 if len(problems) == 0 else 1)
+
+if __name__ == '__main__':
+    main()